@@ -0,0 +1,271 @@
+"""
+Replays searches against the webserver and reports throughput, latency and errors:
+
+    python -m benchmarks.load_test --url http://127.0.0.1:8000 --queries queries.txt
+    python -m benchmarks.load_test --in-process --rate 50 --concurrency 64
+
+Queries come from a log with one per line, either plain text or JSON objects with
+a "query" and optionally "mode", "min_score", "since" and "domain" (the search
+form's fields), and are otherwise made up from benchmarks.synthetic's vocabulary.
+With --cache-hit-ratio, that fraction of requests repeats an earlier query instead
+of sending the next one, so the query cache can be tested at a known hit rate.
+
+Without --rate, --concurrency clients send requests back to back. With it, requests
+arrive at random (Poisson) at that rate regardless of how fast they're answered,
+up to --concurrency at once, and latency includes the time a request waited to be
+sent, so a saturated server shows up as latency rather than a lower request rate.
+
+With --in-process, the app is served through httpx's ASGI transport, with the
+stub embedder unless `--embedder model` is given, so the server's own costs can be
+measured without a model or a socket.
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+from collections import Counter
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Iterator, List
+
+import httpx
+import numpy as np
+
+from benchmarks.synthetic import Corpus, CorpusConfig, HashingEmbeddings
+
+SEARCH_PARAMS = ["query", "mode", "min_score", "since", "domain"]
+
+
+def read_query_log(path: str) -> List[dict]:
+    searches = []
+    with open(path, "r") as file:
+        for line in file:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("{"):
+                entry = json.loads(line)
+                searches.append({k: entry[k] for k in SEARCH_PARAMS if entry.get(k)})
+            else:
+                searches.append({"query": line})
+    return searches
+
+
+def synthetic_searches(seed: int) -> Iterator[dict]:
+    corpus = Corpus(CorpusConfig(seed=seed))
+    rng = np.random.default_rng(seed)
+    while True:
+        words = corpus.sample_words(rng, int(rng.integers(1, 5)))
+        yield {"query": " ".join(words)}
+
+
+def request_stream(
+    searches: Iterator[dict],
+    count: int,
+    cache_hit_ratio: float | None,
+    seed: int,
+) -> List[dict]:
+    """
+    `count` searches in the order they'll be sent. Without `cache_hit_ratio`,
+    the searches are replayed as they are, over again if there are too few.
+    """
+    rng = random.Random(seed)
+    sent: List[dict] = []
+    stream: List[dict] = []
+    for _ in range(count):
+        if sent and cache_hit_ratio is not None and rng.random() < cache_hit_ratio:
+            stream.append(rng.choice(sent))
+            continue
+        search = next(searches, None)
+        if search is None:
+            if not sent:
+                raise ValueError("No queries to send")
+            searches = iter(list(sent))
+            search = next(searches)
+        sent.append(search)
+        stream.append(search)
+    return stream
+
+
+@asynccontextmanager
+async def in_process_client(
+    embedder: str, ready_timeout: float
+) -> AsyncIterator[httpx.AsyncClient]:
+    if embedder == "hashing":
+        from embedding_models import set_embedder
+
+        set_embedder(HashingEmbeddings())
+    import webserver
+
+    # httpx's ASGI transport doesn't run the app's lifespan, which loads the
+    # query engine, so it's run here
+    async with webserver.app.router.lifespan_context(webserver.app):
+        # A failed warm up is only logged, and the app never becomes ready
+        deadline = time.monotonic() + ready_timeout
+        while not webserver.ready.is_set():
+            if time.monotonic() > deadline:
+                raise RuntimeError(
+                    f"webserver wasn't ready after {ready_timeout:.0f}s, see its log for why"  # noqa: E501
+                )
+            await asyncio.sleep(0.05)
+        transport = httpx.ASGITransport(app=webserver.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://load-test"
+        ) as client:
+            yield client
+
+
+async def run(
+    client: httpx.AsyncClient,
+    stream: List[dict],
+    concurrency: int,
+    rate: float | None,
+    timeout: float,
+    seed: int,
+) -> dict:
+    latencies: List[float] = []
+    outcomes: Counter[str] = Counter()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def send(search: dict, scheduled: float):
+        async with semaphore:
+            try:
+                response = await client.get("/", params=search, timeout=timeout)
+                outcome = str(response.status_code)
+            except httpx.HTTPError as e:
+                outcome = type(e).__name__
+        latencies.append((time.perf_counter() - scheduled) * 1000)
+        outcomes[outcome] += 1
+
+    start = time.perf_counter()
+    if rate:
+        rng = random.Random(seed)
+        tasks = []
+        scheduled = start
+        for search in stream:
+            scheduled += rng.expovariate(rate)
+            await asyncio.sleep(max(scheduled - time.perf_counter(), 0))
+            tasks.append(asyncio.create_task(send(search, scheduled)))
+        await asyncio.gather(*tasks)
+    else:
+        searches = iter(stream)
+
+        async def client_loop():
+            for search in searches:
+                await send(search, time.perf_counter())
+
+        await asyncio.gather(*(client_loop() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+
+    values = np.asarray(latencies or [0.0])
+    errors = {k: v for k, v in outcomes.items() if k != "200"}
+    return {
+        "requests": len(latencies),
+        "seconds": seconds,
+        "throughput": len(latencies) / seconds if seconds else 0.0,
+        "latency_ms": {
+            "p50": float(np.percentile(values, 50)),
+            "p95": float(np.percentile(values, 95)),
+            "p99": float(np.percentile(values, 99)),
+            "max": float(values.max()),
+        },
+        "errors": sum(errors.values()),
+        "outcomes": dict(outcomes),
+    }
+
+
+async def main(args: argparse.Namespace) -> dict:
+    searches = (
+        iter(read_query_log(args.queries))
+        if args.queries
+        else synthetic_searches(args.seed)
+    )
+    stream = request_stream(searches, args.requests, args.cache_hit_ratio, args.seed)
+    if args.in_process:
+        client_context = in_process_client(args.embedder, args.ready_timeout)
+    else:
+        client_context = httpx.AsyncClient(
+            base_url=args.url,
+            limits=httpx.Limits(max_connections=args.concurrency),
+        )
+    async with client_context as client:
+        for search in stream[: args.warm_up]:
+            await client.get("/", params=search, timeout=args.timeout)
+        return await run(
+            client,
+            stream,
+            args.concurrency,
+            args.rate,
+            args.timeout,
+            args.seed,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Replay searches against the webserver and report latency"
+    )
+    target = parser.add_mutually_exclusive_group()
+    target.add_argument(
+        "--url", default="http://127.0.0.1:8000", help="Server to send requests to"
+    )
+    target.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Serve webserver.app in this process instead, configured by the usual HNSS_* variables",  # noqa: E501
+    )
+    parser.add_argument(
+        "--embedder",
+        choices=["hashing", "model"],
+        default="hashing",
+        help="With --in-process, embed queries with a stub or with the production model",  # noqa: E501
+    )
+    parser.add_argument(
+        "--queries",
+        help="Query log to replay, one query or JSON object per line (synthetic queries otherwise)",  # noqa: E501
+    )
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument(
+        "--concurrency", type=int, default=16, help="Maximum requests in flight"
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        help="Requests per second to send, regardless of responses (back to back otherwise)",  # noqa: E501
+    )
+    parser.add_argument(
+        "--cache-hit-ratio",
+        type=float,
+        help="Fraction of requests that repeat an earlier query (the log is replayed as is otherwise)",  # noqa: E501
+    )
+    parser.add_argument(
+        "--warm-up",
+        type=int,
+        default=0,
+        help="Send the first N requests once, unmeasured, before starting",
+    )
+    parser.add_argument("--timeout", type=float, default=30, help="Seconds")
+    parser.add_argument(
+        "--ready-timeout",
+        type=float,
+        default=300,
+        help="Seconds to wait for the --in-process app to load its query engine",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Path to write the results to, as JSON")
+    args = parser.parse_args()
+
+    result = asyncio.run(main(args))
+    latency = result["latency_ms"]
+    print(
+        f"{result['requests']} requests in {result['seconds']:.2f}s ({result['throughput']:.1f}/s), "  # noqa: E501
+        f"p50 {latency['p50']:.1f} ms, p95 {latency['p95']:.1f} ms, p99 {latency['p99']:.1f} ms, max {latency['max']:.1f} ms"  # noqa: E501
+    )
+    print(f"Responses: {json.dumps(result['outcomes'], sort_keys=True)}")
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump({"config": vars(args), "results": result}, file, indent=2)
+    if result["errors"]:
+        sys.exit(1)
@@ -0,0 +1,367 @@
+"""
+Benchmarks each stage of building and serving the index on a synthetic corpus:
+
+    python -m benchmarks.stages ./bench --entries 5000 --output results.json
+    python -m benchmarks.stages ./bench --entries 5000 --compare results.json
+
+The corpus (a feed repo written by benchmarks.synthetic) is generated in the work
+directory and reused while its settings don't change. Stages run in order, each in
+a fresh process so its peak RSS is its own, and each reads what the previous one
+wrote: extract (git_to_jsonl.py) -> preprocess -> embed (entries-to-embeddings.py)
+-> ingest (chroma-ingest.py) -> index (vector_index.py) -> query (QueryEngine).
+
+Embeddings come from benchmarks.synthetic.HashingEmbeddings unless `--embedder
+model` is given, so everything but the model can be measured without its weights.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+from dataclasses import asdict
+from typing import Callable, Dict, Iterable, List
+
+import numpy as np
+
+from benchmarks.synthetic import Corpus, CorpusConfig, HashingEmbeddings
+
+STAGES = ["extract", "preprocess", "embed", "ingest", "index", "query"]
+
+
+class Timer:
+    """Counts items and times each one from when the previous one was done."""
+
+    def __init__(self, unit: str):
+        self.unit = unit
+        self.latencies: List[float] = []
+        self.start = self.last = time.perf_counter()
+
+    def tick(self, items: int = 1):
+        now = time.perf_counter()
+        # A batch's latency is spread over its items, so throughput is per item
+        self.latencies.extend([(now - self.last) * 1000 / items] * items)
+        self.last = now
+
+    def result(self) -> dict:
+        seconds = time.perf_counter() - self.start
+        latencies = np.asarray(self.latencies or [0.0])
+        return {
+            "items": len(self.latencies),
+            "unit": self.unit,
+            "seconds": seconds,
+            "throughput": len(self.latencies) / seconds if seconds else 0.0,
+            "latency_ms": {
+                "p50": float(np.percentile(latencies, 50)),
+                "p95": float(np.percentile(latencies, 95)),
+                "p99": float(np.percentile(latencies, 99)),
+                "max": float(latencies.max()),
+            },
+        }
+
+
+def stage_extract(workdir: str, args: argparse.Namespace) -> dict:
+    from git_to_jsonl import process_feed_item, yield_feed_items
+
+    timer = Timer("entries")
+    with open(os.path.join(workdir, "data.jsonl"), "w") as file:
+        for feed_item in yield_feed_items(
+            os.path.join(workdir, "feed-repo"), workers=args.workers
+        ):
+            hn_entry = process_feed_item(feed_item)
+            if hn_entry is None:
+                continue
+            file.write(json.dumps(asdict(hn_entry)) + "\n")
+            timer.tick()
+    return timer.result()
+
+
+def stage_preprocess(workdir: str, args: argparse.Namespace) -> dict:
+    from preprocess import iter_preprocessed
+
+    timer = Timer("entries")
+    with open(os.path.join(workdir, "data.jsonl"), "r") as lines:
+        with open(os.path.join(workdir, "preprocessed.jsonl"), "w") as output:
+            for entry in iter_preprocessed(lines, args.workers):
+                output.write(json.dumps(entry) + "\n")
+                timer.tick()
+    return timer.result()
+
+
+def stage_embed(workdir: str, args: argparse.Namespace) -> dict:
+    from embedding_jobs import embed_entries
+    from embedding_models import MODEL_NAME
+    from embeddings_file import JsonlEmbeddingsWriter
+    from preprocess import entry_chunks
+
+    def entries() -> Iterable:
+        with open(os.path.join(workdir, "preprocessed.jsonl"), "r") as lines:
+            for line in lines:
+                preprocessed = json.loads(line)
+                yield preprocessed["guid"], entry_chunks(preprocessed)
+
+    timer = Timer("entries")
+    writer = JsonlEmbeddingsWriter(
+        open(os.path.join(workdir, "embeddings.jsonl"), "wb"), MODEL_NAME, None
+    )
+    try:
+        for batch in embed_entries(
+            entries(), args.batch_tokens, args.workers, args.threads_per_worker
+        ):
+            for id, embeddings in batch:
+                writer.write(id, embeddings)
+            timer.tick(len(batch))
+    finally:
+        writer.close()
+    return timer.result()
+
+
+def stage_ingest(workdir: str, args: argparse.Namespace) -> dict:
+    from embeddings_file import iter_embedding_lists
+    from ingester import Ingester
+
+    data_db = os.path.join(workdir, "data.db")
+    chroma_dir = os.path.join(workdir, "chroma")
+    for path in [data_db, f"{data_db}-wal", f"{data_db}-shm"]:
+        if os.path.exists(path):
+            os.remove(path)
+    shutil.rmtree(chroma_dir, ignore_errors=True)
+
+    timer = Timer("entries")
+    ingester = Ingester(data_db, chroma_dir)
+    try:
+        with open(os.path.join(workdir, "data.jsonl"), "r") as lines:
+            for line, (id, embeddings) in zip(
+                lines, iter_embedding_lists(os.path.join(workdir, "embeddings.jsonl"))
+            ):
+                entry = json.loads(line)
+                assert entry["guid"] == id
+                ingester.add(entry, embeddings)
+                timer.tick()
+    finally:
+        ingester.close()
+    return timer.result()
+
+
+def stage_index(workdir: str, args: argparse.Namespace) -> dict:
+    from vector_index import build_index
+
+    index_dir = os.path.join(workdir, "vector-index")
+    shutil.rmtree(index_dir, ignore_errors=True)
+    timer = Timer("indexes")
+    build_index(os.path.join(workdir, "embeddings.jsonl"), index_dir, nlist=args.nlist)
+    timer.tick()
+    return timer.result()
+
+
+def stage_query(workdir: str, args: argparse.Namespace) -> dict:
+    from chroma_query import QueryEngine
+    from vector_index import MatrixIndex
+
+    engine = QueryEngine(
+        os.path.join(workdir, "data.db"),
+        vector_backend=MatrixIndex(os.path.join(workdir, "vector-index")),
+    )
+    corpus = Corpus(corpus_config(args))
+    rng = np.random.default_rng(corpus.config.seed)
+    queries = [
+        " ".join(corpus.sample_words(rng, int(rng.integers(1, 5))))
+        for _ in range(args.queries)
+    ]
+    timer = Timer("queries")
+    for i, query in enumerate(queries):
+        # Alternates vector and hybrid search, the two modes the webserver uses
+        mode = "hybrid" if i % 2 else "vector"
+        list(engine.query(query, args.k, include_text=False, mode=mode))
+        timer.tick()
+    return timer.result()
+
+
+STAGE_FUNCTIONS: Dict[str, Callable[[str, argparse.Namespace], dict]] = {
+    "extract": stage_extract,
+    "preprocess": stage_preprocess,
+    "embed": stage_embed,
+    "ingest": stage_ingest,
+    "index": stage_index,
+    "query": stage_query,
+}
+
+
+def run_stage(stage: str, workdir: str, args: argparse.Namespace, results):
+    if args.embedder == "hashing":
+        from embedding_models import set_embedder
+
+        set_embedder(HashingEmbeddings())
+    result = STAGE_FUNCTIONS[stage](workdir, args)
+    # ru_maxrss is in KiB on Linux. Worker pools have exited by now, so
+    # RUSAGE_CHILDREN covers the largest of them.
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    result["workers_peak_rss_mb"] = (
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    )
+    results.put(result)
+
+
+def run_stage_process(stage: str, workdir: str, args: argparse.Namespace) -> dict:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_stage, args=(stage, workdir, args, results))
+    process.start()
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"Stage {stage} failed with exit code {process.exitcode}")
+    return results.get()
+
+
+def corpus_config(args: argparse.Namespace) -> CorpusConfig:
+    return CorpusConfig(
+        entries=args.entries,
+        words=args.words,
+        feed_items=args.feed_items,
+        new_per_commit=args.new_per_commit,
+        seed=args.seed,
+    )
+
+
+def prepare_corpus(workdir: str, config: CorpusConfig):
+    """Writes the feed repo, unless one with the same config is already there."""
+    config_path = os.path.join(workdir, "corpus.json")
+    if os.path.exists(config_path):
+        with open(config_path, "r") as file:
+            if json.load(file) == asdict(config):
+                return
+    repo = os.path.join(workdir, "feed-repo")
+    shutil.rmtree(repo, ignore_errors=True)
+    start = time.monotonic()
+    Corpus(config).write_feed_repo(repo)
+    print(
+        f"Generated {config.entries} entries in {time.monotonic() - start:.1f}s",
+        file=sys.stderr,
+    )
+    with open(config_path, "w") as file:
+        json.dump(asdict(config), file)
+
+
+def environment() -> dict:
+    commit = subprocess.run(
+        ["git", "rev-parse", "HEAD"],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    )
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "commit": commit.stdout.strip() if commit.returncode == 0 else None,
+    }
+
+
+def compare(baseline: dict, results: dict, tolerance: float) -> List[str]:
+    """
+    Prints each stage's throughput, p95 latency and peak RSS relative to
+    `baseline`, and returns the ones that are worse by more than `tolerance`.
+    """
+    regressions = []
+    print(f"{'stage':<12} {'throughput':>12} {'p95 latency':>12} {'peak RSS':>12}")
+    for stage, result in results["stages"].items():
+        base = baseline["stages"].get(stage)
+        if base is None:
+            continue
+        # Each ratio is > 1 when this run is worse
+        ratios = {
+            "throughput": base["throughput"] / max(result["throughput"], 1e-9),
+            "p95 latency": result["latency_ms"]["p95"]
+            / max(base["latency_ms"]["p95"], 1e-9),
+            "peak RSS": result["peak_rss_mb"] / max(base["peak_rss_mb"], 1e-9),
+        }
+        print(f"{stage:<12} " + " ".join(f"{r:>11.2f}x" for r in ratios.values()))
+        regressions.extend(
+            f"{stage} {metric} is {r:.2f}x worse"
+            for metric, r in ratios.items()
+            if r > 1 + tolerance
+        )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Benchmark ingest, embedding and query stages on a synthetic corpus"
+    )
+    parser.add_argument("workdir", help="Directory for the corpus and stage outputs")
+    parser.add_argument(
+        "--stages",
+        nargs="*",
+        choices=STAGES,
+        default=STAGES,
+        help="Stages to run (each needs the output of the ones before it)",
+    )
+    parser.add_argument("--entries", type=int, default=2000)
+    parser.add_argument(
+        "--words", type=int, default=600, help="Mean words of content per entry"
+    )
+    parser.add_argument("--feed-items", type=int, default=30, help="Items per feed")
+    parser.add_argument(
+        "--new-per-commit", type=int, default=5, help="New feed items per commit"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--embedder",
+        choices=["hashing", "model"],
+        default="hashing",
+        help="Embed with a stub that needs no weights, or with the production model",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Worker processes for the extract, preprocess and embed stages (0 runs in-process)",  # noqa: E501
+    )
+    parser.add_argument("--threads-per-worker", type=int, default=0)
+    parser.add_argument("--batch-tokens", type=int, default=8192)
+    parser.add_argument("--nlist", type=int, default=0, help="IVF clusters to build")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--output", help="Path to write the results to, as JSON")
+    parser.add_argument(
+        "--compare", help="Results JSON of a previous run to compare to"
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="How much worse than --compare a metric can be before exiting with an error",  # noqa: E501
+    )
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    prepare_corpus(args.workdir, corpus_config(args))
+    results = {
+        "config": vars(args),
+        "environment": environment(),
+        "stages": {},
+    }
+    print(
+        f"{'stage':<12} {'items':>8} {'seconds':>8} {'items/s':>10} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'RSS MB':>8}"  # noqa: E501
+    )
+    for stage in args.stages:
+        result = run_stage_process(stage, args.workdir, args)
+        results["stages"][stage] = result
+        latency = result["latency_ms"]
+        print(
+            f"{stage:<12} {result['items']:>8} {result['seconds']:>8.2f} {result['throughput']:>10.1f} {latency['p50']:>8.2f} {latency['p95']:>8.2f} {latency['p99']:>8.2f} {result['peak_rss_mb']:>8.0f}"  # noqa: E501
+        )
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.compare:
+        with open(args.compare, "r") as file:
+            regressions = compare(json.load(file), results, args.tolerance)
+        if regressions:
+            print("\n".join(regressions), file=sys.stderr)
+            sys.exit(1)
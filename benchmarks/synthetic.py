@@ -0,0 +1,153 @@
+"""
+A synthetic corpus for benchmarks: HN entries with readable-content HTML, a feed
+repo with the same layout as hacker-news-small-sites' `generated` branch, and an
+embedder that doesn't need model weights.
+"""
+
+import os
+import subprocess
+import zlib
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime
+from functools import lru_cache
+from typing import Iterator, List
+
+import numpy as np
+
+FEED_PATH = "feeds/hn-small-sites-score-1.xml"
+
+
+@dataclass
+class CorpusConfig:
+    entries: int = 2000
+    # Mean words of readable content per entry. Lengths are log-normal, so some
+    # pages are several times longer, as real ones are.
+    words: int = 600
+    # Items in each version of the feed, and how many are new in each commit
+    feed_items: int = 30
+    new_per_commit: int = 5
+    vocabulary: int = 20_000
+    seed: int = 0
+
+
+class Corpus:
+    def __init__(self, config: CorpusConfig):
+        self.config = config
+        rng = np.random.default_rng(config.seed)
+        # Pronounceable-ish words of 2-5 syllables
+        syllables = [c + v for c in "bcdfghklmnprstvz" for v in "aeiou"]
+        self.words = [
+            "".join(rng.choice(syllables, size=rng.integers(2, 6)))
+            for _ in range(config.vocabulary)
+        ]
+        # Zipf-distributed word frequencies, like natural text
+        weights = 1 / np.arange(1, config.vocabulary + 1)
+        self.word_probabilities = weights / weights.sum()
+
+    def sample_words(self, rng: np.random.Generator, count: int) -> List[str]:
+        indexes = rng.choice(len(self.words), size=count, p=self.word_probabilities)
+        return [self.words[i] for i in indexes]
+
+    def html(self, rng: np.random.Generator) -> str:
+        count = max(20, int(rng.lognormal(np.log(self.config.words), 0.75)))
+        words = self.sample_words(rng, count)
+        paragraphs = []
+        for start in range(0, len(words), 80):
+            sentences = [
+                " ".join(words[s : s + 12]).capitalize() + "."
+                for s in range(start, min(start + 80, len(words)), 12)
+            ]
+            paragraphs.append(f"<p>{' '.join(sentences)}</p>")
+        return f"<div><h1>{' '.join(words[:6])}</h1>{''.join(paragraphs)}</div>"
+
+    def item(self, i: int) -> str:
+        """The <item> for entry `i`, as hacker-news-small-sites generates them."""
+        rng = np.random.default_rng((self.config.seed, i))
+        title = " ".join(self.sample_words(rng, int(rng.integers(4, 10)))).title()
+        domain = f"{self.words[i % 500]}.{['com', 'org', 'net', 'dev'][i % 4]}"
+        pub_date = datetime(2020, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=i)
+        description = (
+            f'<p>Score {int(rng.zipf(1.8)) % 1000} | Comments {int(rng.zipf(2)) % 500} (<a href="https://news.ycombinator.com/item?id={i}">HN</a>)</p>'  # noqa: E501
+            f"<!-- hnss:readable-content --><hr/>{self.html(rng)}"
+        )
+        return (
+            f"<item><title>{title}</title><link>https://{domain}/{i}</link>"
+            f"<guid>hacker-news-small-sites-{i}</guid>"
+            f"<pubDate>{format_datetime(pub_date, usegmt=True)}</pubDate>"
+            f"<description><![CDATA[{description}]]></description></item>"
+        )
+
+    def feeds(self) -> Iterator[str]:
+        """Each version of the feed, oldest first, with the newest items first."""
+        config = self.config
+        end = min(config.feed_items, config.entries)
+        while True:
+            items = range(end - 1, max(end - config.feed_items, 0) - 1, -1)
+            yield (
+                '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+                + "".join(self.item(i) for i in items)
+                + "</channel></rss>"
+            )
+            if end >= config.entries:
+                return
+            end = min(end + config.new_per_commit, config.entries)
+
+    def write_feed_repo(self, path: str):
+        """
+        A git repo whose `generated` branch has a commit per version of the feed,
+        written with fast-import rather than a commit at a time.
+        """
+        os.makedirs(path, exist_ok=True)
+        subprocess.run(["git", "init", "-q", path], check=True)
+        process = subprocess.Popen(
+            ["git", "fast-import", "--quiet"], stdin=subprocess.PIPE, cwd=path
+        )
+        assert process.stdin
+        for i, feed in enumerate(self.feeds()):
+            data = feed.encode("utf-8")
+            message = f"Feed {i}".encode("utf-8")
+            process.stdin.write(
+                b"commit refs/heads/generated\n"
+                + f"committer Benchmark <benchmark@example.com> {1577836800 + i * 14400} +0000\n".encode()  # noqa: E501
+                + f"data {len(message)}\n".encode()
+                + message
+                + f"\nM 100644 inline {FEED_PATH}\ndata {len(data)}\n".encode()
+                + data
+                + b"\n"
+            )
+        process.stdin.close()
+        if process.wait() != 0:
+            raise RuntimeError(f"git fast-import failed in {path}")
+
+
+class HashingEmbeddings:
+    """
+    An embedding_models.Embedder without model weights: a text's embedding is the
+    normalized sum of a fixed random vector per word, so texts sharing words are
+    near each other. It costs about as much as tokenizing, so benchmarks using it
+    measure everything but the model.
+    """
+
+    query_instruction = ""
+
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    @lru_cache(maxsize=1 << 16)
+    def _word_vector(self, word: str) -> np.ndarray:
+        rng = np.random.default_rng(zlib.crc32(word.encode("utf-8")))
+        return rng.standard_normal(self.dim).astype(np.float32)
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in text.lower().split():
+            vector += self._word_vector(word)
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self._embed(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed(self.query_instruction + text)
@@ -0,0 +1,106 @@
+"""
+Compares recall and latency of MatrixIndex (exact and IVF) against Chroma.
+
+    python -m benchmarks.vector_index ./vector-index --chroma-dir ./chroma
+
+Recall is measured against MatrixIndex's exact search. Queries are stored vectors
+with a little noise added, unless --queries is given, in which case each line is
+embedded with the production embedder.
+"""
+
+import argparse
+import os
+import statistics
+import time
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+
+from vector_index import MatrixIndex
+
+QueryFn = Callable[[List[float], int], Tuple[List[str], List[float]]]
+
+
+def sample_queries(index: MatrixIndex, num_queries: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(index.count(), num_queries, replace=False)
+    queries = np.asarray(index.vectors[np.sort(rows)])
+    queries += rng.normal(scale=0.05, size=queries.shape).astype(np.float32)
+    queries /= np.linalg.norm(queries, axis=1, keepdims=True)
+    return queries.tolist()
+
+
+def embed_queries(path: str) -> List[List[float]]:
+    from embedding_models import get_embedder
+
+    embedder, _ = get_embedder()
+    with open(path, "r") as file:
+        return [embedder.embed_query(line.strip()) for line in file if line.strip()]
+
+
+def run(query: QueryFn, queries: List[List[float]], k: int):
+    results, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        ids, _ = query(q, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+        results.append(ids)
+    return results, latencies
+
+
+def percentile(values: List[float], p: float) -> float:
+    return statistics.quantiles(values, n=100, method="inclusive")[int(p) - 1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("index_dir", help="Directory of a MatrixIndex")
+    parser.add_argument("--chroma-dir", help="Also benchmark this Chroma directory")
+    parser.add_argument(
+        "--quantized-index",
+        nargs="*",
+        default=[],
+        help="Also benchmark these MatrixIndex directories, with and without re-ranking",  # noqa: E501
+    )
+    parser.add_argument("--queries", help="File of text queries, one per line")
+    parser.add_argument("--num-queries", type=int, default=200)
+    parser.add_argument("-k", type=int, default=80)
+    parser.add_argument(
+        "--nprobe", type=int, nargs="*", default=[4, 16, 64], help="IVF probes"
+    )
+    args = parser.parse_args()
+
+    exact = MatrixIndex(args.index_dir, exact=True)
+    queries = (
+        embed_queries(args.queries)
+        if args.queries
+        else sample_queries(exact, args.num_queries)
+    )
+
+    backends: Dict[str, QueryFn] = {"exact": exact.query}
+    if exact.centroids is not None:
+        for nprobe in args.nprobe:
+            backends[f"ivf nprobe={nprobe}"] = MatrixIndex(
+                args.index_dir, nprobe=nprobe
+            ).query
+    for index_dir in args.quantized_index:
+        for rerank in [0, 4]:
+            backends[f"{os.path.basename(index_dir)} rerank={rerank}"] = MatrixIndex(
+                index_dir, exact=True, rerank=rerank
+            ).query
+    if args.chroma_dir:
+        from chroma_query import ChromaBackend
+
+        backends["chroma"] = ChromaBackend(args.chroma_dir).query
+
+    truth, _ = run(exact.query, queries, args.k)
+    print(f"{len(queries)} queries, k={args.k}, {exact.count():,} vectors")
+    print(f"{'backend':<20} {'recall':>8} {'p50 ms':>8} {'p95 ms':>8}")
+    for name, query in backends.items():
+        results, latencies = run(query, queries, args.k)
+        recall = statistics.mean(
+            len(set(r) & set(t)) / max(len(t), 1) for r, t in zip(results, truth)
+        )
+        print(
+            f"{name:<20} {recall:>8.3f} {percentile(latencies, 50):>8.2f} {percentile(latencies, 95):>8.2f}"  # noqa: E501
+        )
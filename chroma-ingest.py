@@ -1,66 +1,69 @@
 import argparse
 import json
-import sqlite3
+import time
+from itertools import zip_longest
+from typing import NoReturn
 
-import chromadb
+from embeddings_file import iter_embedding_lists
+from ingester import Ingester
 
 parser = argparse.ArgumentParser()
 parser.add_argument("data_path", help="Path to the JSONL data file")
 parser.add_argument(
     "embeddings_path",
-    help="Path to an embeddings file generated with entries-to-embeddings.py, corresponding to the data file",  # noqa: E501
+    help="Path to an embeddings file (or --format binary directory) generated with entries-to-embeddings.py, corresponding to the data file",  # noqa: E501
 )
-args = parser.parse_args()
-
-vector_client = chromadb.PersistentClient(path="./chroma")
-vector_collection = vector_client.get_or_create_collection(name="hn_small_sites")
-db_client = sqlite3.connect("./data.db")
-
-db_client.execute(
-    """
-    CREATE TABLE IF NOT EXISTS documents (
-        id TEXT PRIMARY KEY,
-        content TEXT
-    )
-"""
+parser.add_argument(
+    "--batch-size",
+    type=int,
+    default=4096,
+    help="Number of embeddings to write to Chroma (and documents to SQLite) at once",
 )
+parser.add_argument(
+    "--no-text-index",
+    action="store_true",
+    help="Skip the full-text index (it can be built later with text_index.py)",
+)
+args = parser.parse_args()
 
+ingester = Ingester(batch_size=args.batch_size, text_index=not args.no_text_index)
 
-def count_lines_in_file(file_path: str) -> int:
-    with open(file_path, "r") as file:
-        return sum(1 for _ in file)
-
-
-count_data = count_lines_in_file(args.data_path)
-count_embeddings = count_lines_in_file(args.embeddings_path)
 
-if count_data != count_embeddings:
+def stop(reason: str) -> NoReturn:
+    # The batch in progress is dropped, but earlier ones were already written
+    ingested = ingester.count_documents - len(ingester.batch_documents)
+    ingester.close(flush=False)
     raise ValueError(
-        f"Data file has {count_data} lines, while embeddings file has {count_embeddings} lines. They should have the same number of lines."  # noqa: E501
+        f"{reason}, stopped after {ingester.count_documents} entries. The first {ingested} entries were already ingested."  # noqa: E501
     )
 
 
+start = time.monotonic()
 with open(args.data_path, "r") as file_data:
-    with open(args.embeddings_path, "r") as file_embeddings:
-        for i_l, (line_data, line_embeddings) in enumerate(
-            zip(file_data, file_embeddings)
-        ):
-            data = json.loads(line_embeddings)
-            id = data["id"]
-            embeddings = next(iter(data["embeddings"].values()))
-            for i_e, embedding in enumerate(embeddings):
-                vector_collection.add(
-                    ids=f"{id}:{i_e}",
-                    embeddings=embedding,
-                    metadatas={"id": id, "index": i_e},
-                )
-            db_client.execute(
-                """
-                INSERT OR IGNORE INTO documents (id, content) VALUES (?, ?)
-            """,
-                (id, line_data),
+    # Both files are streamed once, instead of counting their lines up front
+    for line_data, id_embeddings in zip_longest(
+        file_data, iter_embedding_lists(args.embeddings_path)
+    ):
+        if line_data is None or id_embeddings is None:
+            stop(
+                "Data file and embeddings file have a different number of entries. They should have the same number of entries"  # noqa: E501
+            )
+        entry = json.loads(line_data)
+        id, embeddings = id_embeddings
+        if id != entry["guid"]:
+            stop(
+                f"Embeddings for {id} are on the line of {entry['guid']} in the data file, so the files don't correspond"  # noqa: E501
             )
-            db_client.commit()
+        if ingester.add(entry, embeddings):
+            count_documents = ingester.count_documents
+            elapsed = time.monotonic() - start
             print(
-                f"Processing {i_l+1} out of {count_data}", end="\r"
-            )  # Print i out of count on the same line
+                f"Ingested {count_documents} documents ({count_documents / elapsed:.1f} docs/s)",  # noqa: E501
+                end="\r",
+            )
+    ingester.close()
+
+elapsed = time.monotonic() - start
+print(
+    f"Ingested {ingester.count_documents} documents and {ingester.count_embeddings} embeddings in {elapsed:.1f}s ({ingester.count_documents / elapsed:.1f} docs/s)"  # noqa: E501
+)
@@ -1,19 +1,37 @@
 import argparse
 import json
 import sqlite3
+import threading
 from collections import defaultdict
-from datetime import datetime
+from dataclasses import dataclass
+from datetime import datetime, timezone
 from email.utils import parsedate_to_datetime
-from typing import Annotated, Generator, List, Tuple, TypedDict
+from typing import (
+    Annotated,
+    Callable,
+    Collection,
+    Dict,
+    Generator,
+    List,
+    Literal,
+    Protocol,
+    Set,
+    Tuple,
+    TypedDict,
+    get_args,
+)
 
-import chromadb
 from pydantic import BaseModel, BeforeValidator
 
+from documents_db import MAX_QUERY_PARAMS, DocumentFilters
 from embedding_models import get_embedder
+from text_index import fts_query
 
 
 class QueryResultMetadata(TypedDict):
     embedding_id: str
+    # Index of the chunk within its document
+    chunk_index: int
     distance: float
 
 
@@ -29,7 +47,7 @@ class QueryResultMetadata(TypedDict):
 #   "link": "https://ajxs.me/blog/Giving_Ada_a_Chance.html",
 #   "text": "<div id=\"readability-page-1\" class=\"page\"><div>\n\t\t<p><span>TL;DR:</span>\n\tAda is an extremely interesting and..." # noqa: E501
 # }
-class HNSSEntry(BaseModel):
+class HNSSEntryMetadata(BaseModel):
     guid: str
     num_score: int
     num_comments: int
@@ -37,55 +55,399 @@ class HNSSEntry(BaseModel):
     pub_date: Annotated[datetime, BeforeValidator(parsedate_to_datetime)]
     title: str
     link: str
-    text: str
     last_source_commit: str | None
 
 
-class QueryEngine:
-    def __init__(self, data_db: str, chroma_dir: str):
+class HNSSEntry(HNSSEntryMetadata):
+    text: str
+
+
+# documents columns, and the HNSSEntry fields they're read into
+_ENTRY_COLUMNS = [
+    "id",
+    "num_score",
+    "num_comments",
+    "thread_link",
+    "pub_date",
+    "title",
+    "link",
+    "last_source_commit",
+]
+_ENTRY_FIELDS = ["guid", *_ENTRY_COLUMNS[1:], "text"]
+# Chroma binds every id of an `$in` filter as a parameter, so larger sets of
+# documents are filtered after over-fetching instead
+_CHROMA_MAX_FILTER_IDS = 10_000
+_CHROMA_OVERFETCH = 4
+
+# vector: nearest chunks by embedding. text: BM25 over the full-text index built by
+# text_index.py. hybrid: both, merged with reciprocal rank fusion.
+SearchMode = Literal["vector", "text", "hybrid"]
+
+# Document id -> its matching chunks (none if it only matched the text index)
+DocumentResults = Dict[str, List[QueryResultMetadata]]
+
+
+def group_by_document(ids: List[str], distances: List[float]) -> DocumentResults:
+    """Groups chunk results from a VectorBackend by document, nearest first."""
+    doc_results = defaultdict[str, List[QueryResultMetadata]](list)
+    for id, ds in zip(ids, distances):
+        hnss_id, _, chunk_index = id.rpartition(":")
+        doc_results[hnss_id].append(
+            {"embedding_id": id, "chunk_index": int(chunk_index), "distance": ds}
+        )
+    return doc_results
+
+
+AggregationRule = Literal["min", "mean", "sum"]
+
+
+@dataclass(frozen=True)
+class ChunkAggregation:
+    """
+    How a document is scored from its matching chunks, lower being better. `min`
+    is its nearest chunk, `mean` the mean of its `top_n` nearest, and `sum` the
+    negated sum of its chunks' cosine similarities (1 - d / 2 for normalized
+    embeddings), which favors documents that match in many places.
+    """
+
+    rule: AggregationRule = "min"
+    top_n: int = 3
+    # Chunks fetched per document requested, doubled until there are enough
+    # distinct documents
+    overfetch: int = 4
+
+    def __post_init__(self):
+        if self.rule not in get_args(AggregationRule):
+            raise ValueError(f"Unknown chunk aggregation rule: {self.rule}")
+
+    def score(self, distances: List[float]) -> float:
+        if self.rule == "mean":
+            nearest = distances[: self.top_n]
+            return sum(nearest) / len(nearest)
+        if self.rule == "sum":
+            return -sum(1 - d / 2 for d in distances)
+        return distances[0]
+
+
+def aggregate_chunks(
+    doc_results: DocumentResults, num_results: int, aggregation: ChunkAggregation
+) -> DocumentResults:
+    """The best `num_results` documents by `aggregation`, best first."""
+    scores = {
+        id: aggregation.score([c["distance"] for c in chunks])
+        for id, chunks in doc_results.items()
+    }
+    best = sorted(scores, key=lambda id: scores[id])[:num_results]
+    return {id: doc_results[id] for id in best}
+
+
+def reciprocal_rank_fusion(rankings: List[List[str]], k: int = 60) -> List[str]:
+    """
+    Orders ids by the sum of 1 / (k + rank) over each ranking they appear in, which
+    needs no calibration between BM25 scores and distances.
+    """
+    scores: Dict[str, float] = defaultdict(float)
+    for ranking in rankings:
+        for rank, id in enumerate(ranking, start=1):
+            scores[id] += 1 / (k + rank)
+    return sorted(scores, key=lambda id: scores[id], reverse=True)
+
+
+def fuse_results(
+    vector_results: DocumentResults, text_ids: List[str]
+) -> DocumentResults:
+    """
+    Merges vector results with documents from the text index, keeping as many
+    documents as the longer of the two.
+    """
+    if not text_ids:
+        return vector_results
+    rankings = [r for r in (list(vector_results), text_ids) if r]
+    fused = reciprocal_rank_fusion(rankings)[: max(len(vector_results), len(text_ids))]
+    return {id: vector_results.get(id, []) for id in fused}
+
+
+class VectorBackend(Protocol):
+    def query(
+        self,
+        embedding: List[float],
+        num_results: int,
+        document_ids: Collection[str] | None = None,
+    ) -> Tuple[List[str], List[float]]:
+        """
+        Returns the ids and distances of the nearest `num_results` chunks, only
+        considering chunks of `document_ids` if it's given
+        """
+        ...
+
+    def count(self) -> int:
+        ...
+
+    def upsert(self, ids: List[str], embeddings: List[List[float]]):
+        """Adds (or replaces) chunks by embedding id, e.g. "<guid>:<index>"."""
+        ...
+
+
+class ChromaBackend:
+    def __init__(self, chroma_dir: str):
+        # Deferred so that serving from a MatrixIndex doesn't pay for importing it
+        import chromadb
+
         self.vector_client = chromadb.PersistentClient(path=chroma_dir)
         self.vector_collection = self.vector_client.get_collection(
             name="hn_small_sites"
         )
-        self.db_client = sqlite3.connect(data_db)
+
+    def query(
+        self,
+        embedding: List[float],
+        num_results: int,
+        document_ids: Collection[str] | None = None,
+    ) -> Tuple[List[str], List[float]]:
+        if document_ids is None:
+            results = self.vector_collection.query(embedding, n_results=num_results)
+            return self._ids_distances(results)
+        if len(document_ids) <= _CHROMA_MAX_FILTER_IDS:
+            results = self.vector_collection.query(
+                embedding,
+                n_results=num_results,
+                where={"id": {"$in": list(document_ids)}},
+            )
+            return self._ids_distances(results)
+        # Over-fetches, with twice as many chunks each time, until enough are left
+        # after filtering or Chroma has no more to return. Returning fewer would
+        # look to search_vectors like there are no more matching chunks.
+        num_chunks = num_results * _CHROMA_OVERFETCH
+        while True:
+            ids, distances = self._ids_distances(
+                self.vector_collection.query(embedding, n_results=num_chunks)
+            )
+            kept = [
+                (id, d)
+                for id, d in zip(ids, distances)
+                if id.split(":")[0] in document_ids
+            ][:num_results]
+            if len(kept) >= num_results or len(ids) < num_chunks:
+                return [id for id, _ in kept], [d for _, d in kept]
+            num_chunks *= 2
+
+    @staticmethod
+    def _ids_distances(results) -> Tuple[List[str], List[float]]:
+        return (
+            results["ids"][0],
+            results["distances"][0] if results["distances"] else [],
+        )
+
+    def count(self) -> int:
+        return self.vector_collection.count()
+
+    def upsert(self, ids: List[str], embeddings: List[List[float]]):
+        metadatas = []
+        for id in ids:
+            document_id, _, index = id.rpartition(":")
+            metadatas.append({"id": document_id, "index": int(index)})
+        self.vector_collection.upsert(
+            ids=ids, embeddings=embeddings, metadatas=metadatas
+        )
+
+
+class QueryEngine:
+    def __init__(
+        self,
+        data_db: str,
+        chroma_dir: str = "./chroma",
+        vector_backend: VectorBackend | None = None,
+        embed_query: Callable[[str], List[float]] | None = None,
+    ):
+        self.vector_backend = vector_backend or ChromaBackend(chroma_dir)
+        self.data_db = data_db
+        self._local = threading.local()
         self.embedder, self.embedder_name = get_embedder()
+        # e.g. a QueryEmbeddingBatcher's, to batch queries from concurrent callers
+        self.embed_query = embed_query or self.embedder.embed_query
+
+    @property
+    def db_client(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads, so each thread that
+        # queries gets its own
+        db_client = getattr(self._local, "db_client", None)
+        if db_client is None:
+            db_client = self._local.db_client = sqlite3.connect(self.data_db)
+        return db_client
 
     def query(
-        self, query: str, num_results: int = 10
-    ) -> Generator[Tuple[HNSSEntry, List[QueryResultMetadata]], None, None]:
-        query_embeddings = self.embedder.embed_query(query)
-        results = self.vector_collection.query(query_embeddings, n_results=num_results)
-        doc_results = defaultdict[str, List[QueryResultMetadata]](list)
-        ids = results["ids"][0]
-        distances = results["distances"][0] if results["distances"] else []
-        for id, ds in zip(ids, distances):
-            hnss_id = id.split(":")[0]
-            doc_results[hnss_id].append({"embedding_id": id, "distance": ds})
+        self,
+        query: str,
+        num_results: int = 10,
+        include_text: bool = True,
+        mode: SearchMode = "vector",
+        filters: DocumentFilters | None = None,
+        aggregation: ChunkAggregation = ChunkAggregation(),
+    ) -> Generator[Tuple[HNSSEntryMetadata, List[QueryResultMetadata]], None, None]:
+        """
+        Yields up to `num_results` distinct documents, with the chunks that matched.
+
+        Without `include_text`, entries are HNSSEntryMetadata and their (large) text
+        isn't read at all. With `filters`, only matching documents are ranked, so
+        there are still up to `num_results` results.
+        """
+        document_ids = self.filter_documents(filters) if filters else None
+        vector_results: DocumentResults = {}
+        if mode != "text":
+            vector_results = self.search_vectors(
+                self.embed_query(query), num_results, document_ids, aggregation
+            )
+        text_ids = (
+            self.search_text(query, num_results, filters) if mode != "vector" else []
+        )
+        yield from self.hydrate(fuse_results(vector_results, text_ids), include_text)
+
+    def search_vectors(
+        self,
+        embedding: List[float],
+        num_results: int,
+        document_ids: Collection[str] | None = None,
+        aggregation: ChunkAggregation = ChunkAggregation(),
+    ) -> DocumentResults:
+        """
+        The best `num_results` documents by `aggregation` of their nearest chunks.
+        Chunks are over-fetched, and fetched again with twice as many until there
+        are `num_results` distinct documents among them (or there are no more).
+        """
+        num_chunks = num_results * aggregation.overfetch
+        while True:
+            ids, distances = self.vector_backend.query(
+                embedding, num_chunks, document_ids
+            )
+            doc_results = group_by_document(ids, distances)
+            if len(doc_results) >= num_results or len(ids) < num_chunks:
+                break
+            num_chunks *= 2
+        return aggregate_chunks(doc_results, num_results, aggregation)
+
+    def hydrate(
+        self, doc_results: DocumentResults, include_text: bool = True
+    ) -> Generator[Tuple[HNSSEntryMetadata, List[QueryResultMetadata]], None, None]:
+        docs = self.get_documents(list(doc_results.keys()), include_text)
         for id, sr in doc_results.items():
+            if id in docs:
+                yield docs[id], sr
+
+    def search_text(
+        self, query: str, num_results: int, filters: DocumentFilters | None = None
+    ) -> List[str]:
+        """Ids of the best `num_results` documents by BM25, with titles weighted 2x."""
+        match = fts_query(query)
+        # FTS5 rejects an empty MATCH, e.g. for a whitespace-only query
+        if not match:
+            return []
+        where, params = (filters or DocumentFilters()).where()
+        cursor = self.db_client.execute(
+            f"""
+            SELECT documents.id FROM documents_fts
+            JOIN documents ON documents.rowid = documents_fts.rowid
+            WHERE documents_fts MATCH ? AND {where}
+            ORDER BY bm25(documents_fts, 2.0, 1.0)
+            LIMIT ?
+        """,
+            (match, *params, num_results),
+        )
+        return [id for (id,) in cursor]
+
+    def filter_documents(self, filters: DocumentFilters) -> Set[str]:
+        """Ids of the documents matching `filters`, found through column indexes."""
+        where, params = filters.where()
+        cursor = self.db_client.execute(
+            f"SELECT id FROM documents WHERE {where}", params
+        )
+        return {id for (id,) in cursor}
+
+    def has_text_index(self) -> bool:
+        return bool(
+            self.db_client.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'documents_fts'"
+            ).fetchone()
+        )
+
+    def get_documents(
+        self, ids: List[str], include_text: bool = True
+    ) -> Dict[str, HNSSEntryMetadata]:
+        # Rows are already typed, so they skip pydantic's validation
+        model = HNSSEntry if include_text else HNSSEntryMetadata
+        text_column = ", document_texts.text" if include_text else ""
+        text_join = (
+            "JOIN document_texts ON document_texts.rowid = documents.rowid"
+            if include_text
+            else ""
+        )
+        docs = {}
+        for i in range(0, len(ids), MAX_QUERY_PARAMS):
+            batch = ids[i : i + MAX_QUERY_PARAMS]
             cursor = self.db_client.execute(
-                """
-                SELECT id, content FROM documents WHERE id = ?
+                f"""
+                SELECT {", ".join(f"documents.{c}" for c in _ENTRY_COLUMNS)}
+                {text_column}
+                FROM documents {text_join}
+                WHERE documents.id IN ({",".join("?" * len(batch))})
             """,
-                (id,),
+                batch,
             )
-            row = cursor.fetchone()
-            if row:
-                yield HNSSEntry.model_validate_json(row[1]), sr
+            for row in cursor:
+                fields = dict(zip(_ENTRY_FIELDS, row))
+                fields["pub_date"] = datetime.fromtimestamp(
+                    fields["pub_date"], timezone.utc
+                )
+                docs[fields["guid"]] = model.model_construct(**fields)
+        return docs
 
     def count_documents(self) -> int:
         return self.db_client.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
 
     def count_embeddings(self) -> int:
-        return self.vector_collection.count()
+        return self.vector_backend.count()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("data_db", help="Path to the data.db file")
     parser.add_argument("query", help="Query to embed and search for in the DB")
+    parser.add_argument(
+        "--mode",
+        choices=["vector", "text", "hybrid"],
+        default="vector",
+        help="text and hybrid need the full-text index built by chroma-ingest.py or text_index.py",  # noqa: E501
+    )
+    parser.add_argument(
+        "--vector-index",
+        help="Search a MatrixIndex built with vector_index.py instead of ./chroma",
+    )
+    parser.add_argument("--min-score", type=int, help="Only search entries scored >=")
+    parser.add_argument(
+        "--since",
+        type=lambda s: datetime.fromisoformat(s).replace(tzinfo=timezone.utc),
+        help="Only search entries published on or after this date (YYYY-MM-DD, UTC)",
+    )
+    parser.add_argument("--domain", help="Only search entries linking to this domain")
+    parser.add_argument(
+        "--aggregation",
+        choices=["min", "mean", "sum"],
+        default="min",
+        help="How documents are scored from their chunks, see ChunkAggregation",
+    )
     args = parser.parse_args()
 
-    for h, _ in QueryEngine(args.data_db, "./chroma").query(args.query):
-        doc = h.model_dump()
-        doc.pop("text")
-        print(json.dumps(doc, indent=2))
+    vector_backend = None
+    if args.vector_index:
+        from vector_index import MatrixIndex
+
+        vector_backend = MatrixIndex(args.vector_index)
+    for h, _ in QueryEngine(args.data_db, "./chroma", vector_backend).query(
+        args.query,
+        include_text=False,
+        mode=args.mode,
+        filters=DocumentFilters(
+            min_score=args.min_score, since=args.since, domain=args.domain
+        ),
+        aggregation=ChunkAggregation(rule=args.aggregation),
+    ):
+        print(json.dumps(h.model_dump(mode="json"), indent=2))
@@ -0,0 +1,198 @@
+import argparse
+import json
+import sqlite3
+from dataclasses import dataclass
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Iterable, List, Tuple
+from urllib.parse import urlsplit
+
+# Rows converted at once by migrate_documents
+_BATCH_SIZE = 1024
+# Parameters bound in one query, e.g. ids in an IN (...). SQLite's default
+# SQLITE_MAX_VARIABLE_NUMBER on older builds is 999.
+MAX_QUERY_PARAMS = 500
+
+# Columns of `documents`, in the order document_row() returns them
+DOCUMENT_COLUMNS = [
+    "id",
+    "title",
+    "link",
+    "domain",
+    "thread_link",
+    "pub_date",
+    "num_score",
+    "num_comments",
+    "last_source_commit",
+]
+
+
+def create_documents_schema(db_client: sqlite3.Connection):
+    """
+    One row per entry with typed columns (`pub_date` in Unix seconds) and indexes
+    on the ones searches filter by. The readable-content HTML, which is most of
+    each entry's size, is kept in `document_texts` (keyed by `documents` rowid) so
+    reading metadata never touches it.
+    """
+    db_client.execute(
+        """
+        CREATE TABLE IF NOT EXISTS documents (
+            id TEXT PRIMARY KEY,
+            title TEXT NOT NULL,
+            link TEXT NOT NULL,
+            domain TEXT NOT NULL,
+            thread_link TEXT NOT NULL,
+            pub_date INTEGER NOT NULL,
+            num_score INTEGER NOT NULL,
+            num_comments INTEGER NOT NULL,
+            last_source_commit TEXT
+        )
+    """
+    )
+    db_client.execute(
+        """
+        CREATE TABLE IF NOT EXISTS document_texts (
+            rowid INTEGER PRIMARY KEY,
+            text TEXT NOT NULL
+        )
+    """
+    )
+    for column in ["pub_date", "num_score", "domain"]:
+        db_client.execute(
+            f"CREATE INDEX IF NOT EXISTS documents_{column} ON documents ({column})"
+        )
+
+
+def link_domain(link: str) -> str:
+    domain = (urlsplit(link).hostname or "").lower()
+    return domain.removeprefix("www.")
+
+
+def document_row(entry: dict) -> Tuple[Tuple[Any, ...], str]:
+    """A JSONL entry -> (values for DOCUMENT_COLUMNS, text)."""
+    return (
+        (
+            entry["guid"],
+            entry["title"],
+            entry["link"],
+            link_domain(entry["link"]),
+            entry["thread_link"],
+            int(parsedate_to_datetime(entry["pub_date"]).timestamp()),
+            int(entry["num_score"]),
+            int(entry["num_comments"]),
+            entry.get("last_source_commit"),
+        ),
+        entry.get("text", ""),
+    )
+
+
+def insert_documents(db_client: sqlite3.Connection, entries: Iterable[dict]) -> int:
+    """
+    Inserts entries whose guid isn't already stored (the first copy wins) and
+    returns the largest rowid from before, so the new documents are exactly those
+    after it (SQLite only ever assigns larger rowids).
+    """
+    (last_rowid,) = db_client.execute(
+        "SELECT COALESCE(MAX(rowid), 0) FROM documents"
+    ).fetchone()
+    rows = [document_row(e) for e in entries]
+    db_client.executemany(
+        f"""
+        INSERT OR IGNORE INTO documents ({", ".join(DOCUMENT_COLUMNS)})
+        VALUES ({", ".join("?" * len(DOCUMENT_COLUMNS))})
+    """,
+        [columns for columns, _ in rows],
+    )
+    texts: Dict[str, str] = {}
+    for columns, text in rows:
+        texts.setdefault(columns[0], text)
+    new_documents = db_client.execute(
+        "SELECT rowid, id FROM documents WHERE rowid > ?", (last_rowid,)
+    )
+    db_client.executemany(
+        "INSERT INTO document_texts (rowid, text) VALUES (?, ?)",
+        [(rowid, texts[id]) for rowid, id in new_documents],
+    )
+    return last_rowid
+
+
+@dataclass(frozen=True)
+class DocumentFilters:
+    """Restricts a search to documents matching every field that's set."""
+
+    min_score: int | None = None
+    since: datetime | None = None
+    until: datetime | None = None
+    domain: str | None = None
+
+    def __bool__(self) -> bool:
+        return any(v is not None for v in self.__dict__.values())
+
+    def where(self, table: str = "documents") -> Tuple[str, List[Any]]:
+        """A SQL condition on `table` (an alias of `documents`) and its params."""
+        conditions, params = ["1"], []
+        if self.min_score is not None:
+            conditions.append(f"{table}.num_score >= ?")
+            params.append(self.min_score)
+        if self.since is not None:
+            conditions.append(f"{table}.pub_date >= ?")
+            params.append(int(self.since.timestamp()))
+        if self.until is not None:
+            conditions.append(f"{table}.pub_date < ?")
+            params.append(int(self.until.timestamp()))
+        if self.domain is not None:
+            conditions.append(f"{table}.domain = ?")
+            # Accepts "example.com", "www.example.com" or a URL
+            domain = self.domain if "//" in self.domain else f"//{self.domain}"
+            params.append(link_domain(domain))
+        return " AND ".join(conditions), params
+
+
+def migrate_documents(db_client: sqlite3.Connection) -> bool:
+    """
+    Converts a `documents (id, content)` table of raw JSONL lines, as written by
+    earlier versions of chroma-ingest.py, to the current schema. Rowids are kept,
+    so an existing full-text index stays valid. Returns whether there was
+    anything to convert.
+    """
+    columns = {row[1] for row in db_client.execute("PRAGMA table_info(documents)")}
+    if "content" not in columns:
+        return False
+    with db_client:
+        # Python's sqlite3 doesn't start a transaction for DDL on its own, and this
+        # should never be left half done
+        db_client.execute("BEGIN")
+        db_client.execute("ALTER TABLE documents RENAME TO documents_json")
+        create_documents_schema(db_client)
+        cursor = db_client.execute("SELECT rowid, content FROM documents_json")
+        for batch in iter(lambda: cursor.fetchmany(_BATCH_SIZE), []):
+            rows = [(rowid, *document_row(json.loads(c))) for rowid, c in batch]
+            db_client.executemany(
+                f"""
+                INSERT INTO documents (rowid, {", ".join(DOCUMENT_COLUMNS)})
+                VALUES ({", ".join("?" * (len(DOCUMENT_COLUMNS) + 1))})
+            """,
+                [(rowid, *columns) for rowid, columns, _ in rows],
+            )
+            db_client.executemany(
+                "INSERT INTO document_texts (rowid, text) VALUES (?, ?)",
+                [(rowid, text) for rowid, _, text in rows],
+            )
+        db_client.execute("DROP TABLE documents_json")
+    return True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert a data.db written by an earlier chroma-ingest.py to typed columns"  # noqa: E501
+    )
+    parser.add_argument("data_db", help="Path to the data.db file")
+    args = parser.parse_args()
+
+    db_client = sqlite3.connect(args.data_db)
+    if migrate_documents(db_client):
+        # Dropping the old table leaves its pages free, but doesn't shrink the file
+        db_client.execute("VACUUM")
+        print(f"Converted {args.data_db}")
+    else:
+        print(f"{args.data_db} is already up to date")
@@ -0,0 +1,66 @@
+import hashlib
+import sqlite3
+from array import array
+from typing import Dict, Iterable, List, Tuple
+
+from documents_db import MAX_QUERY_PARAMS
+
+
+def normalize_chunk(chunk: str) -> str:
+    return " ".join(chunk.split())
+
+
+def chunk_hash(chunk: str) -> str:
+    return hashlib.sha256(normalize_chunk(chunk).encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Persistent map of (model name, chunk hash) to embedding, so re-runs only embed
+    new or changed text. Embeddings are stored as float32, which is what the model
+    produces, so round-tripping through the cache is lossless.
+    """
+
+    def __init__(self, path: str, model_name: str):
+        self.model_name = model_name
+        self.db_client = sqlite3.connect(path)
+        self.db_client.execute("PRAGMA journal_mode=WAL")
+        self.db_client.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                chunk_hash TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                PRIMARY KEY (model, chunk_hash)
+            ) WITHOUT ROWID
+        """
+        )
+
+    def get_many(self, hashes: Iterable[str]) -> Dict[str, List[float]]:
+        hashes = list(set(hashes))
+        found = {}
+        for i in range(0, len(hashes), MAX_QUERY_PARAMS):
+            batch = hashes[i : i + MAX_QUERY_PARAMS]
+            cursor = self.db_client.execute(
+                f"""
+                SELECT chunk_hash, embedding FROM embeddings
+                WHERE model = ? AND chunk_hash IN ({",".join("?" * len(batch))})
+            """,
+                (self.model_name, *batch),
+            )
+            for h, blob in cursor:
+                found[h] = array("f", blob).tolist()
+        return found
+
+    def put_many(self, items: Iterable[Tuple[str, List[float]]]):
+        with self.db_client:
+            self.db_client.executemany(
+                """
+                INSERT OR REPLACE INTO embeddings (model, chunk_hash, embedding)
+                VALUES (?, ?, ?)
+            """,
+                ((self.model_name, h, array("f", e).tobytes()) for h, e in items),
+            )
+
+    def close(self):
+        self.db_client.close()
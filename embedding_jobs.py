@@ -0,0 +1,115 @@
+from collections import deque
+from dataclasses import dataclass
+from multiprocessing.context import BaseContext
+from typing import Deque, Dict, Iterable, Iterator, List, Tuple
+
+from llama_index.core.utils import get_tokenizer
+
+from embedding_cache import EmbeddingCache, chunk_hash
+from embedding_models import get_embedder
+from parallel import bounded_imap
+
+tokenizer = get_tokenizer()
+
+# (guid, chunks) for a single entry
+EntryChunks = Tuple[str, List[str]]
+# (guid, an embedding per chunk) for a single entry
+EntryEmbeddings = Tuple[str, List[List[float]]]
+
+
+@dataclass
+class EntryJob:
+    id: str
+    hashes: List[str]
+    # chunk hash -> embedding, for chunks that were found in the cache
+    embeddings: Dict[str, List[float]]
+    # chunk hash -> chunk, for chunks that still need to be embedded
+    missing: Dict[str, str]
+
+
+def yield_entry_jobs(
+    entries: Iterable[EntryChunks], cache: EmbeddingCache | None
+) -> Iterator[EntryJob]:
+    for id, chunks in entries:
+        hashes = [chunk_hash(c) for c in chunks]
+        known = cache.get_many(hashes) if cache else {}
+        missing = {}
+        for h, c in zip(hashes, chunks):
+            if h not in known:
+                missing.setdefault(h, c)
+        yield EntryJob(id=id, hashes=hashes, embeddings=known, missing=missing)
+
+
+def batch_by_tokens(
+    jobs: Iterable[EntryJob], max_batch_tokens: int
+) -> Iterator[List[EntryJob]]:
+    # Entries are never split across batches, so an entry larger than
+    # max_batch_tokens is sent on its own. Cached chunks don't count.
+    batch: List[EntryJob] = []
+    batch_tokens = 0
+    for job in jobs:
+        tokens = sum(len(tokenizer(c)) for c in job.missing.values())
+        if batch and batch_tokens + tokens > max_batch_tokens:
+            yield batch
+            batch, batch_tokens = [], 0
+        batch.append(job)
+        batch_tokens += tokens
+    if batch:
+        yield batch
+
+
+def embed_texts(texts: List[str]) -> List[List[float]]:
+    if not texts:
+        return []
+    embedder, _ = get_embedder()
+    return embedder.embed_documents(texts)
+
+
+def init_worker(num_threads: int):
+    if num_threads > 0:
+        import torch
+
+        torch.set_num_threads(num_threads)
+    get_embedder()
+
+
+def embed_entries(
+    entries: Iterable[EntryChunks],
+    max_batch_tokens: int,
+    workers: int,
+    threads_per_worker: int,
+    cache: EmbeddingCache | None = None,
+    mp_context: BaseContext | None = None,
+) -> Iterator[List[EntryEmbeddings]]:
+    """
+    Embeds entries' chunks in batches of about `max_batch_tokens` on `workers`
+    processes (0 embeds in-process), skipping chunks that are in `cache` and
+    adding the rest to it. Yields each batch's entries, in input order.
+    """
+    jobs = yield_entry_jobs(entries, cache)
+    in_flight: Deque[List[EntryJob]] = deque()
+
+    def texts_to_embed(batches: Iterable[List[EntryJob]]) -> Iterator[List[str]]:
+        for batch in batches:
+            in_flight.append(batch)
+            yield [c for job in batch for c in job.missing.values()]
+
+    for embeddings in bounded_imap(
+        embed_texts,
+        texts_to_embed(batch_by_tokens(jobs, max_batch_tokens)),
+        workers,
+        initializer=init_worker,
+        initargs=(threads_per_worker,),
+        mp_context=mp_context,
+    ):
+        batch = in_flight.popleft()
+        new_embeddings = zip(
+            (h for job in batch for h in job.missing.keys()), embeddings
+        )
+        if cache:
+            new_embeddings = list(new_embeddings)
+            cache.put_many(new_embeddings)
+        new_embeddings = dict(new_embeddings)
+        for job in batch:
+            job.embeddings.update((h, new_embeddings[h]) for h in job.missing)
+        yield [(job.id, [job.embeddings[h] for h in job.hashes]) for job in batch]
@@ -1,12 +1,254 @@
-from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+import argparse
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from concurrent.futures import Future
+from typing import List, Protocol, Tuple
 
-_embedder = None
+import numpy as np
 
+MODEL_NAME = "BAAI/bge-small-en"
+# A directory written by `python embedding_models.py`, to embed with onnxruntime
+# instead of torch
+ONNX_MODEL_DIR = os.getenv("HNSS_ONNX_MODEL_DIR")
 
-def get_embedder():
+
+class Embedder(Protocol):
+    query_instruction: str
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        ...
+
+    def embed_query(self, text: str) -> List[float]:
+        ...
+
+
+_embedder: Embedder | None = None
+_embedder_lock = threading.Lock()
+# Threads the model runs on, 0 for its default of one per core
+_num_threads = 0
+
+
+def set_num_threads(num_threads: int):
+    """
+    Limits the model to `num_threads` threads: torch's, now if it's been imported
+    or once it is, and those of ONNX sessions created afterwards.
+    """
+    global _num_threads
+    _num_threads = num_threads
+    # Not imported here, so that embedding with onnxruntime doesn't pay for it
+    torch = sys.modules.get("torch")
+    if torch is not None and num_threads > 0:
+        torch.set_num_threads(num_threads)
+
+
+def load_huggingface_embedder() -> Embedder:
+    # Imports langchain, sentence-transformers and torch, which takes seconds
+    from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+
+    set_num_threads(_num_threads)
+    return HuggingFaceBgeEmbeddings(
+        model_name=MODEL_NAME, encode_kwargs={"normalize_embeddings": True}
+    )
+
+
+def get_embedder() -> Tuple[Embedder, str]:
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None:
+            _embedder = (
+                OnnxBgeEmbeddings(ONNX_MODEL_DIR)
+                if ONNX_MODEL_DIR
+                else load_huggingface_embedder()
+            )
+    return _embedder, MODEL_NAME
+
+
+def set_embedder(embedder: Embedder):
+    """
+    Makes get_embedder return `embedder` instead of loading the model, e.g. a stub
+    in benchmarks. Processes forked afterwards inherit it.
+    """
     global _embedder
-    if _embedder is None:
-        _embedder = HuggingFaceBgeEmbeddings(
-            model_name="BAAI/bge-small-en", encode_kwargs={"normalize_embeddings": True}
+    with _embedder_lock:
+        _embedder = embedder
+
+
+def embed_queries(embedder: Embedder, queries: List[str]) -> List[List[float]]:
+    """Same as calling `embedder.embed_query` on each query, in one forward pass."""
+    return embedder.embed_documents([embedder.query_instruction + q for q in queries])
+
+
+class OnnxBgeEmbeddings:
+    """
+    A drop-in for langchain's HuggingFaceBgeEmbeddings that runs a model exported
+    with `export_onnx` in onnxruntime. It only needs onnxruntime and tokenizers
+    (both already dependencies of chromadb), so it loads in a fraction of the time
+    of torch and sentence-transformers.
+    """
+
+    def __init__(self, model_dir: str, batch_size: int = 32):
+        import onnxruntime
+        from tokenizers import Tokenizer
+
+        with open(os.path.join(model_dir, "meta.json"), "r") as file:
+            meta = json.load(file)
+        if meta["model"] != MODEL_NAME:
+            raise ValueError(f"{model_dir} was exported from {meta['model']}")
+        self.query_instruction: str = meta["query_instruction"]
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        self.tokenizer.enable_truncation(meta["max_length"])
+        self.tokenizer.enable_padding(
+            pad_id=meta["pad_id"], pad_token=meta["pad_token"]
+        )
+        options = onnxruntime.SessionOptions()
+        if _num_threads > 0:
+            # The session starts its threads now, and a process forked from this
+            # one (e.g. by serve.py) runs the model on its calling thread alone
+            options.intra_op_num_threads = _num_threads
+        self.session = onnxruntime.InferenceSession(
+            os.path.join(model_dir, "model.onnx"),
+            options,
+            providers=["CPUExecutionProvider"],
+        )
+        self.input_names = {i.name for i in self.session.get_inputs()}
+        self.batch_size = batch_size
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        embeddings: List[List[float]] = []
+        for start in range(0, len(texts), self.batch_size):
+            encodings = self.tokenizer.encode_batch(
+                [t.replace("\n", " ") for t in texts[start : start + self.batch_size]]
+            )
+            inputs = {
+                "input_ids": np.array([e.ids for e in encodings], dtype=np.int64),
+                "attention_mask": np.array(
+                    [e.attention_mask for e in encodings], dtype=np.int64
+                ),
+                "token_type_ids": np.array(
+                    [e.type_ids for e in encodings], dtype=np.int64
+                ),
+            }
+            (hidden,) = self.session.run(
+                ["last_hidden_state"],
+                {k: v for k, v in inputs.items() if k in self.input_names},
+            )
+            # bge pools with the [CLS] token, and we normalize like
+            # `normalize_embeddings=True`
+            cls = hidden[:, 0]
+            cls /= np.linalg.norm(cls, axis=1, keepdims=True)
+            embeddings.extend(cls.tolist())
+        return embeddings
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.embed_documents([self.query_instruction + text])[0]
+
+
+def export_onnx(model_dir: str, opset_version: int = 14):
+    """Exports MODEL_NAME's transformer and tokenizer for OnnxBgeEmbeddings."""
+    import torch
+
+    embedder = load_huggingface_embedder()
+    model = embedder.client  # type: ignore[attr-defined]
+    tokenizer = model.tokenizer
+    os.makedirs(model_dir, exist_ok=True)
+    names = ["input_ids", "attention_mask", "token_type_ids"]
+    dummy = tokenizer(["warm up"], return_tensors="pt")
+    axes = {0: "batch", 1: "tokens"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model[0].auto_model,
+            tuple(dummy[n] for n in names),
+            os.path.join(model_dir, "model.onnx"),
+            input_names=names,
+            output_names=["last_hidden_state", "pooler_output"],
+            dynamic_axes={n: axes for n in names + ["last_hidden_state"]},
+            opset_version=opset_version,
+        )
+    tokenizer.backend_tokenizer.save(os.path.join(model_dir, "tokenizer.json"))
+    with open(os.path.join(model_dir, "meta.json"), "w") as file:
+        json.dump(
+            {
+                "model": MODEL_NAME,
+                "query_instruction": embedder.query_instruction,
+                "max_length": model.max_seq_length,
+                "pad_id": tokenizer.pad_token_id,
+                "pad_token": tokenizer.pad_token,
+            },
+            file,
         )
-    return _embedder, "BAAI/bge-small-en"
+
+
+class QueryEmbeddingBatcher:
+    """
+    Collects queries from concurrent callers for up to `window_ms` (or until
+    `max_batch_size` have arrived) and embeds them in one forward pass, which costs
+    much less per query than embedding them one at a time.
+    """
+
+    def __init__(
+        self,
+        embedder: Embedder,
+        window_ms: float = 5,
+        max_batch_size: int = 16,
+    ):
+        self.embedder = embedder
+        self.window = window_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.queue: "queue.Queue[Tuple[str, Future[List[float]]]]" = queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def embed_query(self, query: str) -> List[float]:
+        future: Future[List[float]] = Future()
+        self._start()
+        self.queue.put((query, future))
+        return future.result()
+
+    def _start(self):
+        # Threads don't survive a fork, so a worker forked from the process that
+        # created this starts its own on first use
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            self.queue = queue.Queue()
+            threading.Thread(
+                target=self._run,
+                args=(self.queue,),
+                name="query-embedding-batcher",
+                daemon=True,
+            ).start()
+            self.pid = os.getpid()
+
+    def _run(self, requests: "queue.Queue[Tuple[str, Future[List[float]]]]"):
+        while True:
+            batch = [requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_batch_size:
+                try:
+                    batch.append(
+                        requests.get(timeout=max(deadline - time.monotonic(), 0))
+                    )
+                except queue.Empty:
+                    break
+            try:
+                embeddings = embed_queries(self.embedder, [q for q, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), embedding in zip(batch, embeddings):
+                future.set_result(embedding)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description=f"Export {MODEL_NAME} to ONNX, to embed with HNSS_ONNX_MODEL_DIR"
+    )
+    parser.add_argument("model_dir", help="Directory to write the model to")
+    args = parser.parse_args()
+
+    export_onnx(args.model_dir)
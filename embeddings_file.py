@@ -0,0 +1,172 @@
+import json
+import os
+from typing import BinaryIO, Iterator, List, Tuple
+
+import numpy as np
+
+from quantization import decode_embeddings, encode_embeddings
+
+
+class JsonlEmbeddingsWriter:
+    """One `{"id", "embeddings"}` JSON object per line."""
+
+    def __init__(self, file: BinaryIO, model_name: str, quantization: str | None):
+        self.file = file
+        self.model_name = model_name
+        self.quantization = quantization
+
+    def write(self, id: str, embeddings: List[List[float]]):
+        result = {
+            "id": id,
+            **encode_embeddings(self.model_name, embeddings, self.quantization),
+        }
+        self.file.write((json.dumps(result) + "\n").encode("utf-8"))
+
+    def flush(self):
+        self.file.flush()
+
+    def position(self) -> int:
+        return self.file.tell()
+
+    def truncate(self, position: int):
+        self.file.seek(position)
+        self.file.truncate()
+
+    def close(self):
+        self.file.close()
+
+
+class BinaryEmbeddingsWriter:
+    """
+    A directory with every embedding in one contiguous `vectors.bin` matrix, the
+    end row of each document in `offsets.bin` (int64), and the document ids in
+    `ids.txt`, so it can be memory-mapped by `EmbeddingsFile` instead of parsed.
+    """
+
+    def __init__(
+        self, path: str, model_name: str, dtype: str = "float32", append: bool = False
+    ):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.meta = {"model": model_name, "dtype": dtype, "dim": None}
+        meta_path = os.path.join(path, "meta.json")
+        if append and os.path.exists(meta_path):
+            with open(meta_path, "r") as file:
+                self.meta["dim"] = json.load(file)["dim"]
+        mode = "ab" if append else "wb"
+        self.file_vectors = open(os.path.join(path, "vectors.bin"), mode)
+        self.file_offsets = open(os.path.join(path, "offsets.bin"), mode)
+        self.file_ids = open(os.path.join(path, "ids.txt"), mode)
+        self._load_counts()
+
+    def _load_counts(self):
+        ends = np.fromfile(os.path.join(self.path, "offsets.bin"), np.int64)
+        self.count_documents = len(ends)
+        self.count_rows = int(ends[-1]) if len(ends) else 0
+
+    def write(self, id: str, embeddings: List[List[float]]):
+        if len(embeddings):
+            matrix = np.asarray(embeddings, dtype=self.meta["dtype"])
+            self.meta["dim"] = matrix.shape[1]
+            self.file_vectors.write(matrix.tobytes())
+            self.count_rows += len(matrix)
+        self.file_offsets.write(np.int64(self.count_rows).tobytes())
+        self.file_ids.write(id.encode("utf-8") + b"\n")
+        self.count_documents += 1
+
+    def flush(self):
+        self.file_vectors.flush()
+        self.file_offsets.flush()
+        self.file_ids.flush()
+        with open(os.path.join(self.path, "meta.json"), "w") as file:
+            json.dump(self.meta, file)
+
+    def position(self) -> int:
+        return self.count_documents
+
+    def truncate(self, position: int):
+        """Drops every document after the first `position`."""
+        self.flush()
+        ends = np.fromfile(os.path.join(self.path, "offsets.bin"), np.int64)
+        rows = int(ends[position - 1]) if position else 0
+        row_size = (self.meta["dim"] or 0) * np.dtype(self.meta["dtype"]).itemsize
+        ids_size = 0
+        with open(os.path.join(self.path, "ids.txt"), "rb") as file:
+            for _ in range(position):
+                ids_size += len(file.readline())
+        os.truncate(os.path.join(self.path, "vectors.bin"), rows * row_size)
+        os.truncate(os.path.join(self.path, "offsets.bin"), position * 8)
+        os.truncate(os.path.join(self.path, "ids.txt"), ids_size)
+        self._load_counts()
+
+    def close(self):
+        self.flush()
+        self.file_vectors.close()
+        self.file_offsets.close()
+        self.file_ids.close()
+
+
+class EmbeddingsFile:
+    """Memory-mapped reader for a directory written by `BinaryEmbeddingsWriter`."""
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, "meta.json"), "r") as file:
+            self.meta = json.load(file)
+        with open(os.path.join(path, "ids.txt"), "r") as file:
+            self.ids = file.read().splitlines()
+        self.ends = np.fromfile(os.path.join(path, "offsets.bin"), np.int64)
+        rows = int(self.ends[-1]) if len(self.ends) else 0
+        dim = self.meta["dim"] or 0
+        self.vectors = (
+            np.memmap(
+                os.path.join(path, "vectors.bin"),
+                dtype=self.meta["dtype"],
+                mode="r",
+                shape=(rows, dim),
+            )
+            if rows
+            else np.empty((0, dim), dtype=self.meta["dtype"])
+        )
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, i: int) -> Tuple[str, np.ndarray]:
+        start = int(self.ends[i - 1]) if i else 0
+        return self.ids[i], self.vectors[start : self.ends[i]]
+
+    def __iter__(self) -> Iterator[Tuple[str, np.ndarray]]:
+        for i in range(len(self)):
+            yield self[i]
+
+
+def iter_embeddings(path: str) -> Iterator[Tuple[str, np.ndarray]]:
+    """
+    Yields (id, embeddings matrix) from an embeddings file generated with
+    entries-to-embeddings.py, in either `--format`. With `--format binary`, the
+    matrices are views of the memory-mapped file, in its dtype.
+    """
+    if os.path.isdir(path):
+        yield from EmbeddingsFile(path)
+        return
+    with open(path, "r") as file:
+        for line in file:
+            data = json.loads(line)
+            embeddings = decode_embeddings(data)
+            yield data["id"], (
+                np.asarray(embeddings, dtype=np.float32)
+                if embeddings
+                else np.empty((0, 0), dtype=np.float32)
+            )
+
+
+def iter_embedding_lists(path: str) -> Iterator[Tuple[str, List[List[float]]]]:
+    """Like `iter_embeddings`, but as lists of floats, e.g. for Chroma."""
+    if os.path.isdir(path):
+        for id, matrix in EmbeddingsFile(path):
+            yield id, matrix.astype(np.float32).tolist()
+        return
+    with open(path, "r") as file:
+        for line in file:
+            data = json.loads(line)
+            yield data["id"], decode_embeddings(data)
@@ -1,48 +1,172 @@
 import argparse
+import itertools
 import json
-from typing import List
+import os
+import sys
+from typing import Iterator
 
-import html2text
-from langchain_community.embeddings import HuggingFaceBgeEmbeddings
-from llama_index.core.node_parser import SentenceSplitter
+from embedding_cache import EmbeddingCache
+from embedding_jobs import EntryChunks, embed_entries
+from embedding_models import MODEL_NAME
+from embeddings_file import BinaryEmbeddingsWriter, JsonlEmbeddingsWriter
+from preprocess import entry_chunks, iter_preprocessed
 
-_embedder = None
 
+def yield_entry_chunks(
+    file_path: str, skip: int = 0, workers: int = 0
+) -> Iterator[EntryChunks]:
+    with open(file_path, "r") as file:
+        lines = itertools.islice(file, skip, None)
+        for entry in iter_preprocessed(lines, workers):
+            yield entry["guid"], entry_chunks(entry)
 
-def get_embedder():
-    global _embedder
-    if _embedder is None:
-        _embedder = HuggingFaceBgeEmbeddings(
-            model_name="BAAI/bge-small-en", encode_kwargs={"normalize_embeddings": True}
-        )
-    return _embedder, "BAAI/bge-small-en"
 
+def load_checkpoint(path: str) -> dict:
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {"entries": 0, "output_offset": 0}
 
-ss = SentenceSplitter(chunk_size=256, chunk_overlap=64)
 
+def save_checkpoint(path: str, entries: int, output_offset: int):
+    with open(f"{path}.tmp", "w") as file:
+        json.dump({"entries": entries, "output_offset": output_offset}, file)
+    os.replace(f"{path}.tmp", path)
 
-def create_embedding(text: str) -> List[List[float]]:
-    embedder, name = get_embedder()
-    embeddings = {}
-    embeddings[name] = []
-    for s in ss.split_text(text):
-        embeddings[name].extend(embedder.embed_documents([s]))
-    return embeddings
 
+def process_hn_entries(
+    file_path: str,
+    output: JsonlEmbeddingsWriter | BinaryEmbeddingsWriter,
+    max_batch_tokens: int,
+    workers: int,
+    threads_per_worker: int,
+    cache: EmbeddingCache | None = None,
+    checkpoint_path: str | None = None,
+    preprocess_workers: int = 0,
+):
+    entries_done = 0
+    if checkpoint_path:
+        checkpoint = load_checkpoint(checkpoint_path)
+        entries_done = checkpoint["entries"]
+        # Drop anything written after the last checkpoint so lines aren't repeated
+        output.truncate(checkpoint["output_offset"])
 
-def process_hn_entries(file_path):
-    with open(file_path, "r") as file:
-        for line in file:
-            entry = json.loads(line)
-            text = html2text.html2text(entry.get("text", ""))
-            print(
-                json.dumps({"id": entry["guid"], "embeddings": create_embedding(text)})
-            )
+    entries = yield_entry_chunks(
+        file_path, skip=entries_done, workers=preprocess_workers
+    )
+    for batch in embed_entries(
+        entries, max_batch_tokens, workers, threads_per_worker, cache
+    ):
+        for id, embeddings in batch:
+            output.write(id, embeddings)
+        entries_done += len(batch)
+        output.flush()
+        if checkpoint_path:
+            save_checkpoint(checkpoint_path, entries_done, output.position())
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
-    parser.add_argument("jsonl_file_path", help="Path to the JSONL file")
+    parser.add_argument(
+        "jsonl_file_path",
+        help="Path to the JSONL file, or to the same entries preprocessed with preprocess.py",  # noqa: E501
+    )
+    parser.add_argument(
+        "--output",
+        help="Path to write the embeddings to (defaults to stdout, for --format jsonl)",
+    )
+    parser.add_argument(
+        "--format",
+        choices=["jsonl", "binary"],
+        default="jsonl",
+        help="jsonl writes a JSON object per entry, binary writes a directory that EmbeddingsFile can memory-map",  # noqa: E501
+    )
+    parser.add_argument(
+        "--dtype",
+        choices=["float32", "float16"],
+        default="float32",
+        help="Precision of embeddings stored with --format binary",
+    )
+    parser.add_argument(
+        "--batch-tokens",
+        type=int,
+        default=8192,
+        help="Approximate number of tokens to send to the model in a single batch",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of worker processes to embed batches in (0 embeds in-process)",
+    )
+    parser.add_argument(
+        "--preprocess-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes to convert HTML and split chunks in (0 does it in-process)",  # noqa: E501
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=0,
+        help="torch threads per worker process (0 leaves torch's default)",
+    )
+    parser.add_argument(
+        "--cache",
+        help="Path to a SQLite embedding cache, so unchanged chunks aren't re-embedded",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        help="Path to a checkpoint file to resume an interrupted run from (requires --output)",  # noqa: E501
+    )
+    parser.add_argument(
+        "--quantize",
+        choices=["int8"],
+        help="Write embeddings as int8 codes with a scale per embedding (--format jsonl only)",  # noqa: E501
+    )
     args = parser.parse_args()
+    if args.checkpoint and not args.output:
+        parser.error("--checkpoint requires --output")
+    if args.format == "binary" and not args.output:
+        parser.error("--format binary requires --output")
+    if args.format == "binary" and args.quantize:
+        parser.error("--quantize is only supported with --format jsonl")
 
-    process_hn_entries(args.jsonl_file_path)
+    cache = EmbeddingCache(args.cache, MODEL_NAME) if args.cache else None
+    # Resuming from a checkpoint truncates the existing output rather than
+    # replacing it
+    resume = bool(args.checkpoint) and os.path.exists(args.output or "")
+    if args.checkpoint and not resume and os.path.exists(args.checkpoint):
+        # The checkpoint's entries and offset refer to an output that's gone
+        print(
+            f"{args.output} doesn't exist, ignoring checkpoint {args.checkpoint}",
+            file=sys.stderr,
+        )
+        os.remove(args.checkpoint)
+    if args.format == "binary":
+        output = BinaryEmbeddingsWriter(
+            args.output, MODEL_NAME, dtype=args.dtype, append=resume
+        )
+    else:
+        # Append mode would ignore seeks, so open for update instead
+        file = open(args.output, "r+b" if resume else "wb") if args.output else None
+        output = JsonlEmbeddingsWriter(
+            file or sys.stdout.buffer, MODEL_NAME, quantization=args.quantize
+        )
+    try:
+        process_hn_entries(
+            args.jsonl_file_path,
+            output,
+            max_batch_tokens=args.batch_tokens,
+            workers=args.workers,
+            threads_per_worker=args.threads_per_worker,
+            cache=cache,
+            checkpoint_path=args.checkpoint,
+            preprocess_workers=args.preprocess_workers,
+        )
+    finally:
+        if args.output:
+            output.close()
+        if cache:
+            cache.close()
@@ -0,0 +1,115 @@
+import gzip
+import logging
+import threading
+import urllib.error
+import urllib.request
+from email.utils import parsedate_to_datetime
+from typing import BinaryIO, Callable, Dict, Iterator, List, cast
+
+from chroma_query import HNSSEntryMetadata
+from git_to_jsonl import FeedItem, HNEntry, iter_feed_items, process_feed_item
+
+logger = logging.getLogger(__name__)
+
+FEED_URL = "https://raw.githubusercontent.com/awendland/hacker-news-small-sites/generated/feeds/hn-small-sites-score-1.xml"  # noqa: E501
+
+# Bytes of the response handed to the parser at once
+_READ_SIZE = 1 << 16
+
+
+class FeedRefresher:
+    """
+    Keeps the items of an RSS feed, in feed order, without their readable content.
+
+    Refreshes are conditional requests (If-None-Match/If-Modified-Since), so an
+    unchanged feed costs a 304 instead of a download. A changed feed is parsed as
+    it's downloaded, and only items with a guid that wasn't in the previous
+    version are processed; the rest are carried over as they were.
+
+    `on_new_entries` is called with the full HNEntry of those items (including
+    their readable content) after each refresh that had any, e.g. to ingest them.
+    """
+
+    def __init__(
+        self,
+        url: str = FEED_URL,
+        timeout: float = 30,
+        on_new_entries: Callable[[List[HNEntry]], None] | None = None,
+    ):
+        self.url = url
+        self.timeout = timeout
+        self.on_new_entries = on_new_entries
+        self.etag: str | None = None
+        self.last_modified: str | None = None
+        # Replaced rather than updated in place, so readers never see a partial
+        # refresh. None until the first successful one.
+        self.entries: List[HNSSEntryMetadata] | None = None
+        self._lock = threading.Lock()
+
+    def refresh(self) -> bool:
+        """Fetches the feed if it's changed, and returns whether it had."""
+        with self._lock:
+            request = urllib.request.Request(
+                self.url, headers={"Accept-Encoding": "gzip"}
+            )
+            if self.entries is not None:
+                if self.etag:
+                    request.add_header("If-None-Match", self.etag)
+                if self.last_modified:
+                    request.add_header("If-Modified-Since", self.last_modified)
+            try:
+                response = urllib.request.urlopen(request, timeout=self.timeout)
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    return False
+                raise
+            with response:
+                body = cast(BinaryIO, response)
+                if response.headers.get("Content-Encoding") == "gzip":
+                    body = cast(BinaryIO, gzip.GzipFile(fileobj=response))
+                known = {e.guid: e for e in self.entries or []}
+                new_entries: List[HNEntry] = []
+                self.entries = list(self._read_entries(body, known, new_entries))
+                # Only once the feed has been read, so a failed refresh is retried
+                # in full
+                self.etag = response.headers.get("ETag")
+                self.last_modified = response.headers.get("Last-Modified")
+        if new_entries and self.on_new_entries:
+            self.on_new_entries(new_entries)
+        return True
+
+    def _read_entries(
+        self,
+        body: BinaryIO,
+        known: Dict[str, HNSSEntryMetadata],
+        new_entries: List[HNEntry],
+    ) -> Iterator[HNSSEntryMetadata]:
+        chunks = iter(lambda: body.read(_READ_SIZE), b"")
+        for guid, fields, error in iter_feed_items(chunks):
+            if guid is not None and guid in known:
+                yield known[guid]
+                continue
+            if fields is None:
+                logger.error(f"Error in an item of {self.url}: {error}")
+                continue
+            feed_item = FeedItem(
+                guid=cast(str, guid), last_source_commit=cast(str, None), **fields
+            )
+            try:
+                hn_entry = process_feed_item(feed_item)
+            except IndexError:
+                logger.error(f"No readable content in {guid}, skipping")
+                continue
+            if hn_entry is None:
+                continue
+            new_entries.append(hn_entry)
+            yield HNSSEntryMetadata.model_construct(
+                guid=hn_entry.guid,
+                num_score=hn_entry.num_score,
+                num_comments=hn_entry.num_comments,
+                thread_link=hn_entry.thread_link,
+                pub_date=parsedate_to_datetime(hn_entry.pub_date),
+                title=hn_entry.title,
+                link=hn_entry.link,
+                last_source_commit=None,
+            )
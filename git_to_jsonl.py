@@ -1,14 +1,20 @@
 import argparse
+import codecs
 import json
 import logging
+import multiprocessing
+import os
 import re
 import subprocess
 import sys
-from dataclasses import asdict, dataclass
-from typing import Generator
+from dataclasses import asdict, dataclass, field
+from multiprocessing.context import BaseContext
+from typing import Dict, Generator, Iterable, Iterator, List, Set, Tuple
 
 from lxml import etree
 
+from parallel import bounded_imap
+
 logger = logging.getLogger(__name__)
 
 
@@ -35,77 +41,327 @@ class HNEntry:
     text: str
 
 
+@dataclass
+class SyncState:
+    """
+    What previous runs have already processed, so incremental runs only look at
+    new commits and only yield guids that haven't been yielded before.
+    """
+
+    last_commit: str | None = None
+    seen_guids: Set[str] = field(default_factory=set)
+    seen_blobs: Set[str] = field(default_factory=set)
+
+    @classmethod
+    def load(cls, path: str) -> "SyncState":
+        if not os.path.exists(path):
+            return cls()
+        with open(path, "r") as file:
+            state = json.load(file)
+        return cls(
+            last_commit=state["last_commit"],
+            seen_guids=set(state["seen_guids"]),
+            seen_blobs=set(state["seen_blobs"]),
+        )
+
+    def save(self, path: str):
+        with open(f"{path}.tmp", "w") as file:
+            json.dump(
+                {
+                    "last_commit": self.last_commit,
+                    "seen_guids": sorted(self.seen_guids),
+                    "seen_blobs": sorted(self.seen_blobs),
+                },
+                file,
+            )
+        os.replace(f"{path}.tmp", path)
+
+
+FEED_PATH = "feeds/hn-small-sites-score-1.xml"
+
+invalid_xml_chars_regex = re.compile(
+    r"[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]"
+)
+
+# (guid, FeedItem fields, error) for a single <item>. guid is None if it couldn't
+# be read, and fields is None if any other field couldn't be read.
+ParsedItem = Tuple[str | None, Dict[str, str] | None, str | None]
+
+
+class GitCatFile:
+    """
+    A long-lived `git cat-file --batch` (or `--batch-check`) process, so reading
+    many objects doesn't spawn a process per object.
+    """
+
+    def __init__(self, repo: str, batch_option: str = "--batch"):
+        self.process = subprocess.Popen(
+            ["git", "cat-file", batch_option],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=repo,
+        )
+        # Bytes of the current object (and its trailing newline) not read yet
+        self.unread = 0
+
+    def info(self, object_name: str) -> Tuple[str, int] | None:
+        """
+        Returns the object's hash and size. With `--batch`, the contents must be
+        read before requesting another object.
+        """
+        assert self.process.stdin and self.process.stdout
+        self.process.stdin.write(object_name.encode() + b"\n")
+        self.process.stdin.flush()
+        header = self.process.stdout.readline()
+        if not header:
+            raise RuntimeError(f"git cat-file exited while reading {object_name}")
+        parts = header.split()
+        if len(parts) != 3:
+            # "<object> missing" or "<object> ambiguous"
+            return None
+        return parts[0].decode(), int(parts[2])
+
+    def read(self, object_name: str) -> bytes | None:
+        assert self.process.stdout
+        info = self.info(object_name)
+        if info is None:
+            return None
+        contents = self.process.stdout.read(info[1])
+        self.process.stdout.read(1)  # Trailing newline
+        return contents
+
+    def iter_chunks(
+        self, object_name: str, chunk_size: int = 1 << 16
+    ) -> Iterator[bytes]:
+        """
+        Yields the object's contents without holding all of it in memory. Closing
+        the generator early discards the rest of the object.
+        """
+        assert self.process.stdout
+        info = self.info(object_name)
+        if info is None:
+            return
+        self.unread = info[1] + 1  # Including the trailing newline
+        try:
+            while self.unread > 1:
+                chunk = self.process.stdout.read(min(chunk_size, self.unread - 1))
+                if not chunk:
+                    raise RuntimeError(
+                        f"git cat-file exited while reading {object_name}"
+                    )
+                self.unread -= len(chunk)
+                yield chunk
+        finally:
+            # Nothing is left to skip once git has exited, e.g. been killed by
+            # close before this generator was
+            while self.unread > 0 and self.process.returncode is None:
+                chunk = self.process.stdout.read(min(chunk_size, self.unread))
+                if not chunk:
+                    break
+                self.unread -= len(chunk)
+            self.unread = 0
+
+    def close(self, kill: bool = False):
+        """
+        Waits for git to exit once it's read everything it's been asked for. With
+        `kill`, or while an object is only partly read, git could be blocked
+        writing output nobody will read, so it's killed instead.
+        """
+        if kill or self.unread:
+            self.process.kill()
+        if self.process.stdin:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        self.process.wait()
+        if self.process.stdout:
+            self.process.stdout.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        # Including GeneratorExit, when a generator reading from git is closed
+        self.close(kill=exc_type is not None)
+
+
+def parse_item(item: etree._Element) -> ParsedItem:
+    guid = None
+    try:
+        guid = item.find("guid").text
+        fields = {
+            "title": item.find("title").text.strip(),
+            "link": item.find("link").text,
+            "pub_date": item.find("pubDate").text,
+            "description": item.find("description").text,
+        }
+        return guid, fields, None
+    except Exception as e:
+        return guid, None, f"item: {item}, {e}"
+
+
+def iter_feed_items(chunks: Iterable[bytes]) -> Iterator[ParsedItem]:
+    """
+    Parses a feed incrementally, so memory scales with the largest <item> rather
+    than the whole feed. Invalid XML characters are stripped as each chunk is
+    decoded, and each <item> is discarded once it's been parsed.
+    """
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    parser = etree.XMLPullParser(
+        events=("end",), tag="item", huge_tree=True, recover=True
+    )
+
+    def read_items() -> Iterator[ParsedItem]:
+        for _, item in parser.read_events():
+            yield parse_item(item)
+            item.clear(keep_tail=True)
+            while item.getprevious() is not None:
+                del item.getparent()[0]
+
+    for chunk in chunks:
+        text = invalid_xml_chars_regex.sub("", decoder.decode(chunk))
+        parser.feed(text.encode("utf-8"))
+        yield from read_items()
+    text = invalid_xml_chars_regex.sub("", decoder.decode(b"", final=True))
+    parser.feed(text.encode("utf-8"))
+    parser.close()
+    yield from read_items()
+
+
+def parse_feed(
+    commit_feed: Tuple[str, bytes]
+) -> Tuple[str, List[ParsedItem] | None, str | None]:
+    commit, raw_feed = commit_feed
+    try:
+        return commit, list(iter_feed_items([raw_feed])), None
+    except (etree.XMLSyntaxError, UnicodeDecodeError) as e:
+        return commit, None, str(e)
+
+
 def yield_feed_items(
-    hn_small_sites_feed_repo: str, until_commit: str = None
+    hn_small_sites_feed_repo: str,
+    until_commit: str = None,
+    workers: int = 0,
+    sync_state: SyncState | None = None,
+    streaming: bool = False,
+    mp_context: BaseContext | None = None,
 ) -> Generator[FeedItem, None, None]:
+    """
+    Yields items from the newest commit on `generated` back to `until_commit`
+    (exclusive). An item is skipped if it was in the previous (newer) commit's
+    feed, or, with a `sync_state`, if its guid has been seen by any previous run.
+    `sync_state` is updated in place once every commit has been processed.
+
+    With `streaming`, each feed is parsed in-process straight from git as it's
+    read, instead of being read whole and handed to one of `workers`.
+    """
     git_command = ["git", "rev-list", "generated"]
+    if until_commit:
+        git_command.append(f"^{until_commit}")
+    if sync_state and sync_state.last_commit:
+        git_command.append(f"^{sync_state.last_commit}")
     res_generated_commits = subprocess.run(
         git_command, capture_output=True, text=True, cwd=hn_small_sites_feed_repo
     )
     if res_generated_commits.returncode != 0:
         logger.error(res_generated_commits.stderr)
         return
-    generated_commits = res_generated_commits.stdout.strip().split("\n")
-    if until_commit:
-        try:
-            continue_after_commit_index = generated_commits.index(until_commit)
-            generated_commits = generated_commits[: continue_after_commit_index - 1]
-        except ValueError:
-            logger.error(f"Commit {until_commit} not found in the list of commits")
-            return
-    prev_guids = set()
-    for commit in generated_commits:
-        try:
-            res_git_show = subprocess.run(
-                ["git", "cat-file", "-p", f"{commit}:feeds/hn-small-sites-score-1.xml"],
-                capture_output=True,
-                text=True,
-                cwd=hn_small_sites_feed_repo,
+    generated_commits = res_generated_commits.stdout.split()
+
+    with GitCatFile(hn_small_sites_feed_repo) as cat_file, GitCatFile(
+        hn_small_sites_feed_repo, "--batch-check"
+    ) as cat_file_check:
+        # Each commit's feed blob, until its items have all been yielded
+        commit_blobs: Dict[str, str] = {}
+
+        def feed_blobs() -> Iterator[Tuple[str, str]]:
+            prev_blob = None
+            for commit in generated_commits:
+                blob_info = cat_file_check.info(f"{commit}:{FEED_PATH}")
+                if blob_info is None:
+                    logger.error(f"Error in commit: {commit}")
+                    logger.error(f"{FEED_PATH} not found")
+                    continue
+                blob = blob_info[0]
+                # An unchanged feed has the same guids as the previous commit, so
+                # none of its items would be yielded
+                if blob == prev_blob:
+                    continue
+                prev_blob = blob
+                if sync_state and blob in sync_state.seen_blobs:
+                    continue
+                commit_blobs[commit] = blob
+                yield commit, blob
+
+        def stream_feeds() -> (
+            Iterator[Tuple[str, Iterator[ParsedItem] | None, str | None]]
+        ):
+            for commit, blob in feed_blobs():
+                chunks = cat_file.iter_chunks(blob)
+                try:
+                    yield commit, iter_feed_items(chunks), None
+                finally:
+                    # Skip whatever wasn't parsed, so cat_file is ready for the
+                    # next object
+                    chunks.close()
+
+        def read_feeds() -> Iterator[Tuple[str, bytes]]:
+            for commit, blob in feed_blobs():
+                raw_feed = cat_file.read(blob)
+                assert raw_feed is not None
+                yield commit, raw_feed
+
+        if streaming:
+            parsed_feeds = stream_feeds()
+        else:
+            # Feeds are parsed in parallel, but results come back in commit order
+            # so prev_guids always refers to the previous commit. Workers aren't
+            # forked from this process by default, or they'd hold cat_file's
+            # pipes open and it would never see EOF.
+            parsed_feeds = bounded_imap(
+                parse_feed,
+                read_feeds(),
+                workers,
+                mp_context=mp_context or multiprocessing.get_context("forkserver"),
             )
-            if res_git_show.returncode != 0:
+
+        prev_guids = set()
+        for commit, items, error in parsed_feeds:
+            blob = commit_blobs.pop(commit)
+            if items is None:
                 logger.error(f"Error in commit: {commit}")
-                logger.error(res_git_show.stderr)
+                logger.error(error)
                 continue
-            generated_feed = re.sub(
-                r"[\x00-\x08\x0b\x0c\x0e-\x1F\uD800-\uDFFF\uFFFE\uFFFF]",
-                "",
-                res_git_show.stdout,
-            )
+            new_guids = set()
             try:
-                feed = etree.fromstring(
-                    generated_feed, parser=etree.XMLParser(huge_tree=True, recover=True)
-                )
-            except etree.XMLSyntaxError as e:
+                for guid, fields, item_error in items:
+                    if guid is not None:
+                        new_guids.add(guid)
+                        if guid in prev_guids:
+                            continue
+                        if sync_state and guid in sync_state.seen_guids:
+                            continue
+                    if fields is None:
+                        logger.error(
+                            f"Error in an item in commit: {commit}, {item_error}"
+                        )
+                        continue
+                    if sync_state:
+                        sync_state.seen_guids.add(guid)
+                    yield FeedItem(guid=guid, last_source_commit=commit, **fields)
+            except (etree.XMLSyntaxError, UnicodeDecodeError) as e:
                 logger.error(f"Error in commit: {commit}")
                 logger.error(e)
                 continue
-            new_guids = set()
-            for item in feed.iter("item"):
-                try:
-                    guid = item.find("guid").text
-                    new_guids.add(guid)
-                    if guid in prev_guids:
-                        continue
-                    title = item.find("title").text.strip()
-                    link = item.find("link").text
-                    pub_date = item.find("pubDate").text
-                    description = item.find("description").text
-                    yield FeedItem(
-                        guid=guid,
-                        title=title,
-                        description=description,
-                        link=link,
-                        pub_date=pub_date,
-                        last_source_commit=commit,
-                    )
-                except Exception as e:
-                    logger.error(f"Error in an item in commit: {commit}, item: {item}")
-                    logger.error(e)
-                    continue
+            # Only now, so a feed that failed to parse or whose items weren't all
+            # yielded is read again by the next run
+            if sync_state:
+                sync_state.seen_blobs.add(blob)
             prev_guids = new_guids
-        except Exception as e:
-            logger.error(f"Error in commit: {commit}")
-            raise e
+
+    if sync_state and generated_commits:
+        sync_state.last_commit = generated_commits[0]
 
 
 metadata_regex = re.compile('Score (\d+) \| Comments (\d+) \(<a href="(\S+?)"')
@@ -146,10 +402,37 @@ def main():
         "HN_SMALL_SITES_FEED_REPO", type=str, help="Path to HN_SMALL_SITES_FEED_REPO"
     )
     parser.add_argument("--until", type=str, help="Commit to scan up until (exclusive)")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of worker processes to parse feeds in (0 parses in-process)",
+    )
+    parser.add_argument(
+        "--state",
+        type=str,
+        help="Path to a sync state file, so only commits and guids that haven't been processed by a previous run are output",  # noqa: E501
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Parse each feed incrementally as it's read from git, to reduce peak memory (ignores --workers)",  # noqa: E501
+    )
     args = parser.parse_args()
-    for feed_item in yield_feed_items(args.HN_SMALL_SITES_FEED_REPO, args.until):
+    sync_state = SyncState.load(args.state) if args.state else None
+    for feed_item in yield_feed_items(
+        args.HN_SMALL_SITES_FEED_REPO,
+        args.until,
+        workers=args.workers,
+        sync_state=sync_state,
+        streaming=args.streaming,
+    ):
         hne = process_feed_item(feed_item)
+        if hne is None:
+            continue
         print(json.dumps(asdict(hne)))
+    if sync_state:
+        sync_state.save(args.state)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+import sqlite3
+from typing import List
+
+import chromadb
+
+from documents_db import create_documents_schema, insert_documents, migrate_documents
+from text_index import create_text_index, index_new_documents
+
+
+class Ingester:
+    """
+    Adds entries to data.db (and its full-text index, unless `text_index` is
+    False) and their chunk embeddings to Chroma, writing both once `batch_size`
+    embeddings or documents have been added. `close` writes the rest.
+    """
+
+    def __init__(
+        self,
+        data_db: str = "./data.db",
+        chroma_dir: str = "./chroma",
+        batch_size: int = 4096,
+        text_index: bool = True,
+    ):
+        self.vector_client = chromadb.PersistentClient(path=chroma_dir)
+        self.vector_collection = self.vector_client.get_or_create_collection(
+            name="hn_small_sites"
+        )
+        self.db_client = sqlite3.connect(data_db)
+        self.db_client.execute("PRAGMA journal_mode=WAL")
+        self.db_client.execute("PRAGMA synchronous=NORMAL")
+        self.text_index = text_index
+
+        migrate_documents(self.db_client)
+        with self.db_client:
+            create_documents_schema(self.db_client)
+            if text_index:
+                create_text_index(self.db_client)
+
+        # Chroma rejects adds larger than what its SQLite backend can bind in one
+        # statement
+        self.batch_size = min(
+            batch_size, getattr(self.vector_client, "max_batch_size", 5461)
+        )
+        self.batch_ids: List[str] = []
+        self.batch_embeddings: List[List[float]] = []
+        self.batch_metadatas: List[dict] = []
+        self.batch_documents: List[dict] = []
+        self.count_documents = 0
+        self.count_embeddings = 0
+
+    def add(self, entry: dict, embeddings: List[List[float]]) -> bool:
+        """Adds a JSONL entry and its embeddings, and returns whether it flushed."""
+        id = entry["guid"]
+        for i_e, embedding in enumerate(embeddings):
+            self.batch_ids.append(f"{id}:{i_e}")
+            self.batch_embeddings.append(embedding)
+            self.batch_metadatas.append({"id": id, "index": i_e})
+        self.batch_documents.append(entry)
+        self.count_documents += 1
+        self.count_embeddings += len(embeddings)
+        if (
+            len(self.batch_ids) >= self.batch_size
+            or len(self.batch_documents) >= self.batch_size
+        ):
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        for i in range(0, len(self.batch_ids), self.batch_size):
+            self.vector_collection.add(
+                ids=self.batch_ids[i : i + self.batch_size],
+                embeddings=self.batch_embeddings[i : i + self.batch_size],
+                metadatas=self.batch_metadatas[i : i + self.batch_size],
+            )
+        with self.db_client:
+            last_rowid = insert_documents(self.db_client, self.batch_documents)
+            if self.text_index:
+                index_new_documents(self.db_client, last_rowid)
+        self.batch_ids.clear()
+        self.batch_embeddings.clear()
+        self.batch_metadatas.clear()
+        self.batch_documents.clear()
+
+    def close(self, flush: bool = True):
+        """Writes what's left (unless `flush` is False, which discards it)."""
+        if flush:
+            self.flush()
+        self.db_client.close()
@@ -0,0 +1,220 @@
+import fcntl
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from array import array
+from collections import deque
+from dataclasses import asdict
+from typing import IO, Callable, Deque, Dict, Iterable, List
+
+from chroma_query import VectorBackend
+from documents_db import create_documents_schema, insert_documents
+from git_to_jsonl import HNEntry
+from preprocess import entry_chunks, preprocess_entry
+from text_index import index_new_documents
+
+logger = logging.getLogger(__name__)
+
+
+def create_live_embeddings_table(db_client: sqlite3.Connection):
+    """
+    Chunk embeddings of documents ingested by LiveIngester, which aren't in the
+    vector index that was built offline. Rowids increase with every write, so
+    readers can pick up where they left off.
+    """
+    db_client.execute(
+        """
+        CREATE TABLE IF NOT EXISTS live_embeddings (
+            document_id TEXT NOT NULL,
+            chunk_index INTEGER NOT NULL,
+            embedding BLOB NOT NULL,
+            PRIMARY KEY (document_id, chunk_index)
+        )
+    """
+    )
+
+
+class LiveIngester:
+    """
+    Embeds entries handed to `submit` on a background thread and adds them to
+    data.db (and its full-text index, if it has one) and the vector backend, so
+    new feed items become searchable without an offline rebuild. At most
+    `max_per_minute` entries are embedded a minute, to leave the CPU to queries.
+
+    An entry's chunk embeddings are written to `live_embeddings` in the same
+    transaction as the document itself, and entries whose guid is already in
+    `documents` are skipped, so submitting one again is harmless. Every process
+    serving from the same data.db adds new `live_embeddings` rows to its own
+    vector backend, but only the one holding `<data_db>.ingest-lock` embeds, so
+    forked workers don't repeat each other's work.
+
+    If ingesting a batch fails, e.g. because data.db is locked, its entries are
+    retried one at a time, and only dropped after `max_attempts` failures (to
+    be picked up by the next offline rebuild).
+    """
+
+    def __init__(
+        self,
+        data_db: str,
+        batch_size: int = 16,
+        max_per_minute: int = 60,
+        sync_interval: float = 30,
+        max_attempts: int = 3,
+        retry_delay: float = 5,
+    ):
+        self.data_db = data_db
+        self.batch_size = batch_size
+        self.max_per_minute = max_per_minute
+        self.sync_interval = sync_interval
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.queue: queue.Queue[HNEntry] = queue.Queue()
+        # Entries of failed batches, and how many times each has failed
+        self._retries: Deque[HNEntry] = deque()
+        self._attempts: Dict[str, int] = {}
+        # Rowid of the last live_embeddings row added to vector_backend
+        self.synced_rowid = 0
+        self._lock_file: IO | None = None
+        self._stopping = threading.Event()
+
+    def submit(self, entries: Iterable[HNEntry]):
+        for entry in entries:
+            self.queue.put(entry)
+
+    def start(
+        self,
+        vector_backend: VectorBackend,
+        embed_documents: Callable[[List[str]], List[List[float]]],
+    ):
+        """Starts the ingestion thread. Entries submitted before are kept."""
+        self.vector_backend = vector_backend
+        self.embed_documents = embed_documents
+        threading.Thread(target=self._run, name="live-ingest", daemon=True).start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _run(self):
+        db_client = sqlite3.connect(self.data_db, timeout=30)
+        db_client.execute("PRAGMA journal_mode=WAL")
+        with db_client:
+            create_documents_schema(db_client)
+            create_live_embeddings_table(db_client)
+        while not self._stopping.is_set():
+            entries: List[HNEntry] = []
+            try:
+                entries = self._next_batch()
+                start = time.monotonic()
+                ingested = 0
+                if entries and self._is_leader():
+                    ingested = self.ingest(db_client, entries)
+                self.sync(db_client)
+                for entry in entries:
+                    self._attempts.pop(entry.guid, None)
+                # Spreads embedding out to at most max_per_minute entries a minute
+                elapsed = time.monotonic() - start
+                self._stopping.wait(
+                    max(0, ingested * 60 / self.max_per_minute - elapsed)
+                )
+            except Exception:
+                logger.exception("Live ingestion failed")
+                self._retry(entries)
+                self._stopping.wait(self.retry_delay)
+
+    def _retry(self, entries: List[HNEntry]):
+        # The feed refresher won't submit these again, so they're only dropped
+        # once they've failed repeatedly
+        for entry in entries:
+            attempts = self._attempts.get(entry.guid, 0) + 1
+            if attempts < self.max_attempts:
+                self._attempts[entry.guid] = attempts
+                self._retries.append(entry)
+            else:
+                self._attempts.pop(entry.guid, None)
+                logger.error(
+                    f"Dropping {entry.guid} after {attempts} failed attempts, it will be ingested by the next offline rebuild"  # noqa: E501
+                )
+
+    def _next_batch(self) -> List[HNEntry]:
+        # Retried on their own, so an entry that always fails doesn't take the
+        # rest of its batch down with it
+        if self._retries:
+            return [self._retries.popleft()]
+        try:
+            entries = [self.queue.get(timeout=self.sync_interval)]
+        except queue.Empty:
+            return []
+        while len(entries) < self.batch_size:
+            try:
+                entries.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return entries
+
+    def _is_leader(self) -> bool:
+        if self._lock_file is None:
+            # Opened in the process that runs the thread, so it isn't inherited
+            # by forked workers
+            self._lock_file = open(f"{self.data_db}.ingest-lock", "w")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def ingest(self, db_client: sqlite3.Connection, entries: List[HNEntry]) -> int:
+        """Adds the entries that aren't in data.db yet, and returns how many."""
+        guids = list({e.guid for e in entries})
+        known = {
+            id
+            for (id,) in db_client.execute(
+                f"SELECT id FROM documents WHERE id IN ({', '.join('?' * len(guids))})",
+                guids,
+            )
+        }
+        new_entries = list({e.guid: e for e in entries if e.guid not in known}.values())
+        if not new_entries:
+            return 0
+        chunks = [entry_chunks(preprocess_entry(asdict(e))) for e in new_entries]
+        texts = [c for cs in chunks for c in cs]
+        embeddings = iter(self.embed_documents(texts) if texts else [])
+        rows = [
+            (entry.guid, i, array("f", next(embeddings)).tobytes())
+            for entry, cs in zip(new_entries, chunks)
+            for i in range(len(cs))
+        ]
+        has_text_index = db_client.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'documents_fts'"
+        ).fetchone()
+        with db_client:
+            last_rowid = insert_documents(db_client, map(asdict, new_entries))
+            db_client.executemany(
+                """
+                INSERT OR REPLACE INTO live_embeddings
+                (document_id, chunk_index, embedding) VALUES (?, ?, ?)
+            """,
+                rows,
+            )
+            if has_text_index:
+                index_new_documents(db_client, last_rowid)
+        logger.info(f"Ingested {len(new_entries)} new documents ({len(rows)} chunks)")
+        return len(new_entries)
+
+    def sync(self, db_client: sqlite3.Connection):
+        """Adds live_embeddings rows written since the last sync to vector_backend."""
+        rows = db_client.execute(
+            """
+            SELECT rowid, document_id, chunk_index, embedding FROM live_embeddings
+            WHERE rowid > ? ORDER BY rowid
+        """,
+            (self.synced_rowid,),
+        ).fetchall()
+        if not rows:
+            return
+        self.vector_backend.upsert(
+            [f"{document_id}:{index}" for _, document_id, index, _ in rows],
+            [array("f", embedding).tolist() for *_, embedding in rows],
+        )
+        self.synced_rowid = rows[-1][0]
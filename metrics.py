@@ -0,0 +1,182 @@
+"""
+Counters, gauges and histograms in the Prometheus text format, without depending on
+prometheus_client. Values are per process, so behind serve.py each scrape of
+/metrics sees whichever worker answered it.
+"""
+
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Tuple
+
+# Upper bounds in seconds, from a cache hit to a cold forward pass
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+LabelValues = Tuple[str, ...]
+
+
+def _format_labels(names: Tuple[str, ...], values: LabelValues, **extra: str) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    if not pairs:
+        return ""
+    escaped = (
+        (n, v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for n, v in pairs
+    )
+    return "{" + ",".join(f'{n}="{v}"' for n, v in escaped) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.lock = threading.Lock()
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1, **labels: str):
+        key = tuple(labels[n] for n in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            values = sorted(self.values.items())
+        for key, value in values:
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Gauge:
+    """A value read from `fn` at scrape time."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.help}",
+            f"# TYPE {self.name} gauge",
+            f"{self.name} {self.fn()}",
+        ]
+
+
+class Histogram:
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        # label values -> (count per bucket, with +Inf last; sum)
+        self.values: Dict[LabelValues, Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels: str):
+        key = tuple(labels[n] for n in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key) or ([0] * (len(self.buckets) + 1), 0)
+            counts[i] += 1
+            self.values[key] = counts, total + value
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = sorted((k, (list(c), s)) for k, (c, s) in self.values.items())
+        for key, (counts, total) in values:
+            cumulative = 0
+            for bound, count in zip([*self.buckets, "+Inf"], counts):
+                cumulative += count
+                labels = _format_labels(self.labels, key, le=str(bound))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Counter | Gauge | Histogram] = []
+
+    def counter(self, name: str, help: str, labels: Tuple[str, ...] = ()) -> Counter:
+        metric = Counter(name, help, labels)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, help: str, fn: Callable[[], float]) -> Gauge:
+        metric = Gauge(name, help, fn)
+        self.metrics.append(metric)
+        return metric
+
+    def histogram(
+        self,
+        name: str,
+        help: str,
+        labels: Tuple[str, ...] = (),
+        buckets: Tuple[float, ...] = LATENCY_BUCKETS,
+    ) -> Histogram:
+        metric = Histogram(name, help, labels, buckets)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(line for m in self.metrics for line in m.render()) + "\n"
+
+
+class StageTimer:
+    """
+    Times the stages of one request, e.g. `with timer.stage("embed"): ...`,
+    observing each into `histogram` (labelled by `stage`) and keeping the
+    request's own durations in `seconds`.
+    """
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.seconds: Dict[str, float] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds[name] = self.seconds.get(name, 0) + elapsed
+            self.histogram.observe(elapsed, stage=name)
+
+    def server_timing(self) -> str:
+        """The durations as a Server-Timing header, shown by browser dev tools."""
+        return ", ".join(f"{n};dur={s * 1000:.2f}" for n, s in self.seconds.items())
@@ -0,0 +1,86 @@
+import queue
+import threading
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from multiprocessing.context import BaseContext
+from typing import Any, Callable, Deque, Iterable, Iterator, Tuple, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+def bounded_imap(
+    fn: Callable[[T], R],
+    iterable: Iterable[T],
+    workers: int,
+    initializer: Callable[..., Any] | None = None,
+    initargs: Tuple[Any, ...] = (),
+    max_pending: int | None = None,
+    mp_context: BaseContext | None = None,
+) -> Iterator[R]:
+    """
+    Like `multiprocessing.Pool.imap`, results come back in input order, but at most
+    `max_pending` tasks are in flight so a lazy `iterable` isn't read ahead of the
+    workers. `workers <= 0` runs everything in the current process.
+    """
+    if workers <= 0:
+        if initializer is not None:
+            initializer(*initargs)
+        yield from map(fn, iterable)
+        return
+    max_pending = max_pending or workers * 2
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=mp_context,
+        initializer=initializer,
+        initargs=initargs,
+    ) as executor:
+        pending: Deque[Future[R]] = deque()
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def prefetch(iterable: Iterable[T], max_pending: int) -> Iterator[T]:
+    """
+    Iterates `iterable` on a background thread, at most `max_pending` items ahead
+    of the consumer, so consecutive stages of a pipeline of generators run at the
+    same time instead of taking turns. Exceptions are re-raised in the consumer.
+    """
+    items: queue.Queue[Tuple[Any, BaseException | None]] = queue.Queue(max_pending)
+    done = object()
+    stopped = threading.Event()
+
+    def put(item: Tuple[Any, BaseException | None]) -> bool:
+        # Gives up once the consumer has, instead of blocking on a full queue
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except BaseException as e:
+            put((done, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stopped.set()
@@ -0,0 +1,310 @@
+import argparse
+import itertools
+import json
+import logging
+import multiprocessing
+import sys
+import time
+from collections import deque
+from dataclasses import asdict
+from multiprocessing.context import BaseContext
+from typing import Deque, Iterable, Iterator, List, TextIO, Tuple
+
+from embedding_cache import EmbeddingCache
+from embedding_jobs import EntryChunks, embed_entries
+from embedding_models import MODEL_NAME
+from embeddings_file import BinaryEmbeddingsWriter, JsonlEmbeddingsWriter
+from git_to_jsonl import SyncState, process_feed_item, yield_feed_items
+from ingester import Ingester
+from parallel import bounded_imap, prefetch
+from preprocess import entry_chunks, preprocess_batch
+
+# Entries handed to a preprocessing worker at once
+_PREPROCESS_BATCH_SIZE = 64
+
+# (JSONL entry, its preprocess.py output)
+PreprocessedEntry = Tuple[dict, dict]
+
+
+def extract(
+    hn_small_sites_feed_repo: str,
+    until_commit: str | None,
+    workers: int,
+    sync_state: SyncState | None,
+    mp_context: BaseContext | None = None,
+    keep: TextIO | None = None,
+) -> Iterator[dict]:
+    """Entries as git_to_jsonl.py would write them."""
+    for feed_item in yield_feed_items(
+        hn_small_sites_feed_repo,
+        until_commit,
+        workers=workers,
+        sync_state=sync_state,
+        mp_context=mp_context,
+    ):
+        hn_entry = process_feed_item(feed_item)
+        if hn_entry is None:
+            continue
+        entry = asdict(hn_entry)
+        if keep:
+            keep.write(json.dumps(entry) + "\n")
+        yield entry
+
+
+def preprocess(
+    entries: Iterable[dict],
+    workers: int,
+    mp_context: BaseContext | None = None,
+    keep: TextIO | None = None,
+) -> Iterator[PreprocessedEntry]:
+    # Entries are sent to the workers, but only their text and chunks come back
+    in_flight: Deque[List[dict]] = deque()
+    entries = iter(entries)
+
+    def batches() -> Iterator[List[dict]]:
+        for batch in iter(
+            lambda: list(itertools.islice(entries, _PREPROCESS_BATCH_SIZE)), []
+        ):
+            in_flight.append(batch)
+            yield batch
+
+    for preprocessed in bounded_imap(
+        preprocess_batch, batches(), workers, mp_context=mp_context
+    ):
+        for entry, p in zip(in_flight.popleft(), preprocessed):
+            if keep:
+                keep.write(json.dumps(p) + "\n")
+            yield entry, p
+
+
+def embed(
+    entries: Iterable[PreprocessedEntry],
+    max_batch_tokens: int,
+    workers: int,
+    threads_per_worker: int,
+    cache_path: str | None = None,
+    keep: JsonlEmbeddingsWriter | BinaryEmbeddingsWriter | None = None,
+    mp_context: BaseContext | None = None,
+) -> Iterator[Tuple[dict, List[List[float]]]]:
+    in_flight: Deque[dict] = deque()
+    # Opened here rather than by the caller, since SQLite connections can only be
+    # used on the thread that opened them and this runs on prefetch's
+    cache = EmbeddingCache(cache_path, MODEL_NAME) if cache_path else None
+
+    def chunks() -> Iterator[EntryChunks]:
+        for entry, preprocessed in entries:
+            in_flight.append(entry)
+            yield entry["guid"], entry_chunks(preprocessed)
+
+    try:
+        for batch in embed_entries(
+            chunks(), max_batch_tokens, workers, threads_per_worker, cache, mp_context
+        ):
+            for id, embeddings in batch:
+                if keep:
+                    keep.write(id, embeddings)
+                yield in_flight.popleft(), embeddings
+    finally:
+        if cache:
+            cache.close()
+
+
+def run_pipeline(
+    hn_small_sites_feed_repo: str,
+    ingester: Ingester,
+    until_commit: str | None = None,
+    sync_state: SyncState | None = None,
+    extract_workers: int = 0,
+    preprocess_workers: int = 0,
+    embed_workers: int = 0,
+    threads_per_worker: int = 0,
+    max_batch_tokens: int = 8192,
+    cache_path: str | None = None,
+    queue_size: int = 256,
+    keep_data: TextIO | None = None,
+    keep_preprocessed: TextIO | None = None,
+    keep_embeddings: JsonlEmbeddingsWriter | BinaryEmbeddingsWriter | None = None,
+):
+    """
+    Streams entries from the feed repo through extraction, preprocessing,
+    embedding and ingestion. Each stage runs on its own thread (and its own pool
+    of worker processes), at most `queue_size` entries ahead of the next, so a
+    full rebuild takes about as long as the slowest stage rather than the sum of
+    all of them. Nothing is written to disk in between unless a `keep_*` output
+    is given.
+    """
+    # The stages' pools are started while the other stages' threads are running,
+    # which fork() doesn't handle safely
+    mp_context = multiprocessing.get_context("forkserver")
+    entries = prefetch(
+        extract(
+            hn_small_sites_feed_repo,
+            until_commit,
+            extract_workers,
+            sync_state,
+            mp_context=mp_context,
+            keep=keep_data,
+        ),
+        queue_size,
+    )
+    preprocessed = prefetch(
+        preprocess(
+            entries, preprocess_workers, mp_context=mp_context, keep=keep_preprocessed
+        ),
+        queue_size,
+    )
+    embedded = embed(
+        preprocessed,
+        max_batch_tokens,
+        embed_workers,
+        threads_per_worker,
+        cache_path,
+        keep=keep_embeddings,
+        mp_context=mp_context,
+    )
+    start = time.monotonic()
+    for entry, embeddings in prefetch(embedded, queue_size):
+        if ingester.add(entry, embeddings):
+            count_documents = ingester.count_documents
+            elapsed = time.monotonic() - start
+            print(
+                f"Ingested {count_documents} documents ({count_documents / elapsed:.1f} docs/s)",  # noqa: E501
+                end="\r",
+                file=sys.stderr,
+            )
+    ingester.flush()
+    elapsed = time.monotonic() - start
+    print(
+        f"Ingested {ingester.count_documents} documents and {ingester.count_embeddings} embeddings in {elapsed:.1f}s",  # noqa: E501
+        file=sys.stderr,
+    )
+
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s - %(levelname)s - %(message)s",
+        stream=sys.stderr,
+    )
+    parser = argparse.ArgumentParser(
+        description="Extract, preprocess, embed and ingest entries from HN_SMALL_SITES_FEED_REPO in one streaming pass"  # noqa: E501
+    )
+    parser.add_argument(
+        "HN_SMALL_SITES_FEED_REPO", type=str, help="Path to HN_SMALL_SITES_FEED_REPO"
+    )
+    parser.add_argument("--until", type=str, help="Commit to scan up until (exclusive)")
+    parser.add_argument(
+        "--state",
+        type=str,
+        help="Path to a sync state file, so only commits and guids that haven't been processed by a previous run are ingested",  # noqa: E501
+    )
+    parser.add_argument(
+        "--extract-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes to parse feeds in (0 parses in-process)",
+    )
+    parser.add_argument(
+        "--preprocess-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes to convert HTML and split chunks in (0 does it in-process)",  # noqa: E501
+    )
+    parser.add_argument(
+        "--embed-workers",
+        type=int,
+        default=0,
+        help="Number of worker processes to embed batches in (0 embeds in-process)",
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=0,
+        help="torch threads per embedding worker process (0 leaves torch's default)",
+    )
+    parser.add_argument(
+        "--batch-tokens",
+        type=int,
+        default=8192,
+        help="Approximate number of tokens to send to the model in a single batch",
+    )
+    parser.add_argument(
+        "--cache",
+        help="Path to a SQLite embedding cache, so unchanged chunks aren't re-embedded",
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=256,
+        help="Number of entries each stage can get ahead of the next",
+    )
+    parser.add_argument(
+        "--batch-size",
+        type=int,
+        default=4096,
+        help="Number of embeddings to write to Chroma (and documents to SQLite) at once",  # noqa: E501
+    )
+    parser.add_argument(
+        "--no-text-index",
+        action="store_true",
+        help="Skip the full-text index (it can be built later with text_index.py)",
+    )
+    parser.add_argument(
+        "--keep-data",
+        help="Also write the entries to this JSONL file, as git_to_jsonl.py would",
+    )
+    parser.add_argument(
+        "--keep-preprocessed",
+        help="Also write the preprocessed entries to this file, as preprocess.py would",
+    )
+    parser.add_argument(
+        "--keep-embeddings",
+        help="Also write the embeddings to this path, as entries-to-embeddings.py would",  # noqa: E501
+    )
+    parser.add_argument(
+        "--embeddings-format",
+        choices=["jsonl", "binary"],
+        default="jsonl",
+        help="Format to write --keep-embeddings in",
+    )
+    args = parser.parse_args()
+
+    sync_state = SyncState.load(args.state) if args.state else None
+    keep_data = open(args.keep_data, "w") if args.keep_data else None
+    keep_preprocessed = (
+        open(args.keep_preprocessed, "w") if args.keep_preprocessed else None
+    )
+    keep_embeddings = None
+    if args.keep_embeddings and args.embeddings_format == "binary":
+        keep_embeddings = BinaryEmbeddingsWriter(args.keep_embeddings, MODEL_NAME)
+    elif args.keep_embeddings:
+        keep_embeddings = JsonlEmbeddingsWriter(
+            open(args.keep_embeddings, "wb"), MODEL_NAME, quantization=None
+        )
+    ingester = Ingester(batch_size=args.batch_size, text_index=not args.no_text_index)
+    try:
+        run_pipeline(
+            args.HN_SMALL_SITES_FEED_REPO,
+            ingester,
+            until_commit=args.until,
+            sync_state=sync_state,
+            extract_workers=args.extract_workers,
+            preprocess_workers=args.preprocess_workers,
+            embed_workers=args.embed_workers,
+            threads_per_worker=args.threads_per_worker,
+            max_batch_tokens=args.batch_tokens,
+            cache_path=args.cache,
+            queue_size=args.queue_size,
+            keep_data=keep_data,
+            keep_preprocessed=keep_preprocessed,
+            keep_embeddings=keep_embeddings,
+        )
+        # Only once everything has been ingested, so an interrupted run is
+        # repeated in full
+        if sync_state:
+            sync_state.save(args.state)
+    finally:
+        ingester.close()
+        for output in [keep_data, keep_preprocessed, keep_embeddings]:
+            if output:
+                output.close()
@@ -0,0 +1,118 @@
+import argparse
+import itertools
+import json
+import time
+from functools import lru_cache
+from typing import Iterable, Iterator, List, Tuple
+
+import html2text
+
+from parallel import bounded_imap
+
+# Lines converted by a worker at once, so pickling overhead stays small
+_BATCH_SIZE = 64
+
+
+@lru_cache(maxsize=None)
+def sentence_splitter():
+    # llama-index is only in the exploration group, so it isn't installed where
+    # the webserver runs. It's imported when text is first split, so importing
+    # this module (e.g. for live_ingest) doesn't need it.
+    from llama_index.core.node_parser import SentenceSplitter
+
+    return SentenceSplitter(chunk_size=256, chunk_overlap=64)
+
+
+# [start, end) character offsets into an entry's text, or the chunk itself when
+# SentenceSplitter didn't reproduce it verbatim (it can drop runs of punctuation)
+ChunkSpan = Tuple[int, int] | str
+
+
+def chunk_spans(text: str, chunks: List[str]) -> List[ChunkSpan]:
+    spans: List[ChunkSpan] = []
+    # Chunks come out in order but overlap, so each one starts at or after the
+    # start of the previous one
+    cursor = 0
+    for chunk in chunks:
+        start = text.find(chunk, cursor)
+        if start < 0:
+            spans.append(chunk)
+        else:
+            spans.append((start, start + len(chunk)))
+            cursor = start
+    return spans
+
+
+def preprocess_entry(entry: dict) -> dict:
+    """A JSONL entry -> {"guid", "text" (the readable text), "chunks" (spans)}."""
+    text = html2text.html2text(entry.get("text", ""))
+    return {
+        "guid": entry["guid"],
+        "text": text,
+        "chunks": chunk_spans(text, sentence_splitter().split_text(text)),
+    }
+
+
+def entry_chunks(preprocessed: dict) -> List[str]:
+    text = preprocessed["text"]
+    return [
+        span if isinstance(span, str) else text[span[0] : span[1]]
+        for span in preprocessed["chunks"]
+    ]
+
+
+def load_or_preprocess(line: str) -> dict:
+    """Accepts a line of either the data JSONL or a file written by this module."""
+    entry = json.loads(line)
+    return entry if "chunks" in entry else preprocess_entry(entry)
+
+
+def preprocess_batch(entries: List[dict]) -> List[dict]:
+    return list(map(preprocess_entry, entries))
+
+
+def _load_or_preprocess_lines(lines: List[str]) -> List[dict]:
+    return list(map(load_or_preprocess, lines))
+
+
+def iter_preprocessed(lines: Iterable[str], workers: int = 0) -> Iterator[dict]:
+    """
+    Preprocesses lines in input order on `workers` processes (0 runs in-process),
+    reading ahead of the consumer by only a few batches.
+    """
+    lines = iter(lines)
+    batches = iter(lambda: list(itertools.islice(lines, _BATCH_SIZE)), [])
+    for batch in bounded_imap(_load_or_preprocess_lines, batches, workers):
+        yield from batch
+
+
+def preprocess_file(input_path: str, output_path: str, workers: int = 0):
+    start = time.monotonic()
+    count = 0
+    with open(input_path, "r") as lines, open(output_path, "w") as output:
+        for entry in iter_preprocessed(lines, workers):
+            output.write(json.dumps(entry) + "\n")
+            count += 1
+            if count % 1000 == 0:
+                elapsed = time.monotonic() - start
+                print(
+                    f"Preprocessed {count} entries ({count / elapsed:.1f}/s)", end="\r"
+                )
+    print(f"Preprocessed {count} entries in {time.monotonic() - start:.1f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert entries' HTML to text and split it into chunks, for entries-to-embeddings.py to reuse across models"  # noqa: E501
+    )
+    parser.add_argument("jsonl_file_path", help="Path to the JSONL file")
+    parser.add_argument("output", help="Path to write the preprocessed entries to")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of worker processes to preprocess in (0 preprocesses in-process)",
+    )
+    args = parser.parse_args()
+
+    preprocess_file(args.jsonl_file_path, args.output, workers=args.workers)
@@ -0,0 +1,109 @@
+from typing import List, Tuple
+
+import numpy as np
+
+
+def quantize_int8(vectors: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Symmetric per-vector scalar quantization, such that
+    `vectors ≈ codes * scales[:, None]`.
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    scales = np.abs(vectors).max(axis=1) / 127
+    scales[scales == 0] = 1
+    codes = np.round(vectors / scales[:, None]).astype(np.int8)
+    return codes, scales.astype(np.float32)
+
+
+def dequantize_int8(codes: np.ndarray, scales: np.ndarray) -> np.ndarray:
+    return codes.astype(np.float32) * scales[:, None]
+
+
+def decode_embeddings(data: dict) -> List[List[float]]:
+    """
+    Returns the embeddings of a line written by entries-to-embeddings.py,
+    dequantizing them if it was written with `--quantize int8`.
+    """
+    embeddings = next(iter(data["embeddings"].values()))
+    if data.get("quantization") != "int8" or not embeddings:
+        return embeddings
+    return dequantize_int8(
+        np.asarray(embeddings, dtype=np.int8), np.asarray(data["scales"], np.float32)
+    ).tolist()
+
+
+def encode_embeddings(
+    model_name: str, embeddings: List[List[float]], quantization: str | None
+) -> dict:
+    """The inverse of `decode_embeddings`, without the id."""
+    if quantization != "int8" or not embeddings:
+        return {"embeddings": {model_name: embeddings}}
+    codes, scales = quantize_int8(np.asarray(embeddings, dtype=np.float32))
+    return {
+        "embeddings": {model_name: codes.tolist()},
+        "quantization": "int8",
+        "scales": scales.tolist(),
+    }
+
+
+def kmeans(
+    vectors: np.ndarray, k: int, iterations: int, rng: np.random.Generator
+) -> np.ndarray:
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments = assign(vectors, centroids)
+        for c in range(k):
+            members = vectors[assignments == c]
+            # Empty clusters keep their previous centroid
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+    return centroids
+
+
+def assign(
+    vectors: np.ndarray, centroids: np.ndarray, block_rows: int = 1 << 14
+) -> np.ndarray:
+    """Index of the nearest centroid to each vector."""
+    centroid_norms = np.square(centroids).sum(axis=1)
+    assignments = np.empty(len(vectors), dtype=np.int32)
+    for start in range(0, len(vectors), block_rows):
+        stop = min(start + block_rows, len(vectors))
+        distances = centroid_norms - 2 * (vectors[start:stop] @ centroids.T)
+        assignments[start:stop] = np.argmin(distances, axis=1)
+    return assignments
+
+
+class ProductQuantizer:
+    """
+    Splits vectors into `num_subvectors` slices and encodes each slice as the
+    index of its nearest of 256 centroids, so a vector takes `num_subvectors`
+    bytes. Distances to a query are summed from a per-query lookup table.
+    """
+
+    def __init__(self, codebooks: np.ndarray):
+        # (num_subvectors, 256, dim / num_subvectors)
+        self.codebooks = codebooks
+
+    @classmethod
+    def train(
+        cls, vectors: np.ndarray, num_subvectors: int, iterations: int, seed: int = 0
+    ) -> "ProductQuantizer":
+        rng = np.random.default_rng(seed)
+        subvectors = np.split(np.asarray(vectors, np.float32), num_subvectors, axis=1)
+        k = min(256, len(vectors))
+        return cls(np.stack([kmeans(s, k, iterations, rng) for s in subvectors]))
+
+    def encode(self, vectors: np.ndarray) -> np.ndarray:
+        subvectors = np.split(vectors, len(self.codebooks), axis=1)
+        return np.stack(
+            [assign(s, c) for s, c in zip(subvectors, self.codebooks)], axis=1
+        ).astype(np.uint8)
+
+    def distance_table(self, q: np.ndarray) -> np.ndarray:
+        subqueries = np.split(q, len(self.codebooks))
+        return np.stack(
+            [np.square(c - s).sum(axis=1) for s, c in zip(subqueries, self.codebooks)]
+        )
+
+    def distances(self, table: np.ndarray, codes: np.ndarray) -> np.ndarray:
+        return table[np.arange(len(table)), codes].sum(axis=1)
@@ -0,0 +1,186 @@
+import json
+import sqlite3
+import sys
+import threading
+from array import array
+from typing import List, Tuple
+
+from cachetools import LRUCache
+
+# (embedding ids, distances), as returned by a VectorBackend
+SearchResults = Tuple[List[str], List[float]]
+
+
+def normalize_query(query: str) -> str:
+    # bge-small-en's tokenizer is uncased and splits on whitespace, so these all
+    # embed identically
+    return " ".join(query.lower().split())
+
+
+def _results_size(value: Tuple[int, Tuple[str, ...], array]) -> int:
+    _, ids, distances = value
+    return (
+        sys.getsizeof(ids)
+        + sum(sys.getsizeof(id) for id in ids)
+        + sys.getsizeof(distances)
+    )
+
+
+def _embedding_size(value: array) -> int:
+    return sys.getsizeof(value)
+
+
+class QueryCache:
+    """
+    Caches search results as embedding ids and distances, so documents are
+    hydrated from the documents DB on read instead of being held in memory, and
+    query embeddings separately, so they survive the results being invalidated.
+    Results are tagged with a `generation` (e.g. the document count) and ignored
+    once it changes.
+
+    Both are LRU caches bounded by an estimate of their size in bytes. With
+    `db_path`, they're backed by a SQLite file that survives restarts and is
+    shared by every worker process pointed at it, where each table keeps the
+    `max_db_rows` most recently written rows.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        model_name: str,
+        db_path: str | None = None,
+        max_db_rows: int = 50_000,
+    ):
+        self.lock = threading.Lock()
+        self.results: LRUCache[str, Tuple[int, Tuple[str, ...], array]] = LRUCache(
+            maxsize=max_bytes * 3 // 4, getsizeof=_results_size
+        )
+        self.embeddings: LRUCache[str, array] = LRUCache(
+            maxsize=max_bytes // 4, getsizeof=_embedding_size
+        )
+        self.model_name = model_name
+        self.db_path = db_path
+        self.max_db_rows = max_db_rows
+        self._local = threading.local()
+        self._pruned_generation = None
+
+    @property
+    def db_client(self) -> sqlite3.Connection:
+        # sqlite3 connections can't be shared between threads
+        db_client = getattr(self._local, "db_client", None)
+        if db_client is None:
+            assert self.db_path
+            db_client = self._local.db_client = sqlite3.connect(self.db_path, timeout=5)
+            db_client.execute("PRAGMA journal_mode=WAL")
+            db_client.execute("PRAGMA synchronous=NORMAL")
+            # Created on first use rather than in __init__, so a server that forks
+            # workers after importing this doesn't share a connection with them
+            with db_client:
+                db_client.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS query_results (
+                        key TEXT PRIMARY KEY,
+                        generation INTEGER NOT NULL,
+                        ids TEXT NOT NULL,
+                        distances BLOB NOT NULL
+                    )
+                """
+                )
+                db_client.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS query_embeddings (
+                        model TEXT NOT NULL,
+                        key TEXT NOT NULL,
+                        embedding BLOB NOT NULL,
+                        PRIMARY KEY (model, key)
+                    )
+                """
+                )
+        return db_client
+
+    def has_results(self, key: str, generation: int) -> bool:
+        """Whether `key`'s results for `generation` are in memory."""
+        with self.lock:
+            value = self.results.get(key)
+        return value is not None and value[0] == generation
+
+    def get_results(self, key: str, generation: int) -> SearchResults | None:
+        with self.lock:
+            value = self.results.get(key)
+        if value is None and self.db_path:
+            row = self.db_client.execute(
+                "SELECT generation, ids, distances FROM query_results WHERE key = ?",
+                (key,),
+            ).fetchone()
+            if row:
+                value = (row[0], tuple(json.loads(row[1])), array("f", row[2]))
+                with self.lock:
+                    self.results[key] = value
+        if value is None or value[0] != generation:
+            return None
+        return list(value[1]), value[2].tolist()
+
+    def put_results(self, key: str, generation: int, results: SearchResults):
+        ids, distances = tuple(results[0]), array("f", results[1])
+        with self.lock:
+            self.results[key] = (generation, ids, distances)
+        if self.db_path:
+            with self.db_client:
+                cursor = self.db_client.execute(
+                    """
+                    INSERT OR REPLACE INTO query_results
+                    (key, generation, ids, distances) VALUES (?, ?, ?, ?)
+                """,
+                    (key, generation, json.dumps(ids), distances.tobytes()),
+                )
+                self._prune("query_results", cursor.lastrowid)
+                # Results from previous generations will never be read again. Only
+                # older ones are deleted, since other workers can briefly be on a
+                # newer generation than this one (or this one on a newer one).
+                if (
+                    self._pruned_generation is None
+                    or generation > self._pruned_generation
+                ):
+                    self.db_client.execute(
+                        "DELETE FROM query_results WHERE generation < ?",
+                        (generation,),
+                    )
+                    self._pruned_generation = generation
+
+    def get_embedding(self, key: str) -> List[float] | None:
+        with self.lock:
+            embedding = self.embeddings.get(key)
+        if embedding is None and self.db_path:
+            row = self.db_client.execute(
+                "SELECT embedding FROM query_embeddings WHERE model = ? AND key = ?",
+                (self.model_name, key),
+            ).fetchone()
+            if row:
+                embedding = array("f", row[0])
+                with self.lock:
+                    self.embeddings[key] = embedding
+        return embedding.tolist() if embedding is not None else None
+
+    def put_embedding(self, key: str, embedding: List[float]):
+        value = array("f", embedding)
+        with self.lock:
+            self.embeddings[key] = value
+        if self.db_path:
+            with self.db_client:
+                cursor = self.db_client.execute(
+                    """
+                    INSERT OR REPLACE INTO query_embeddings (model, key, embedding)
+                    VALUES (?, ?, ?)
+                """,
+                    (self.model_name, key, value.tobytes()),
+                )
+                self._prune("query_embeddings", cursor.lastrowid)
+
+    def _prune(self, table: str, last_rowid: int | None):
+        # INSERT OR REPLACE gives a row the next rowid, so the rows more than
+        # max_db_rows before the one just written are the least recently written
+        if last_rowid is not None and last_rowid > self.max_db_rows:
+            self.db_client.execute(
+                f"DELETE FROM {table} WHERE rowid <= ?",
+                (last_rowid - self.max_db_rows,),
+            )
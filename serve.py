@@ -0,0 +1,133 @@
+import argparse
+import gc
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+from typing import Set
+
+
+def serve_worker(app, sock: socket.socket, threads: int):
+    import uvicorn
+
+    from embedding_models import set_num_threads
+
+    # torch's thread pool doesn't survive a fork, so it's sized in each worker
+    set_num_threads(threads)
+
+    # uvicorn handles SIGINT/SIGTERM itself, finishing in-flight requests first
+    uvicorn.Server(uvicorn.Config(app, lifespan="on")).run(sockets=[sock])
+
+
+def serve(host: str, port: int, workers: int, threads_per_worker: int):
+    """
+    Loads the webserver's query engine (the embedding model and memory-mapped
+    vector index) once, then forks `workers` processes that serve from the same
+    listening socket. The workers share the model weights and index pages
+    copy-on-write with the parent instead of each loading their own, so memory
+    grows with the number of in-flight requests rather than the number of workers.
+
+    Without HNSS_VECTOR_INDEX_DIR, it serves from Chroma in this process instead.
+    """
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+
+    import webserver
+    from embedding_models import set_num_threads
+
+    # Before anything loads the model, which with onnxruntime starts its threads
+    set_num_threads(threads_per_worker)
+    if not webserver.vector_index_dir:
+        # Chroma's client isn't fork-safe, so with Chroma (and so a single worker)
+        # the query engine is loaded and served in this process
+        print(f"Serving on {host}:{port} with Chroma in-process", file=sys.stderr)
+        serve_worker(webserver.app, sock, threads_per_worker)
+        return
+
+    # Each worker warms up on its own: running the model before forking would
+    # leave the workers with torch thread pools that don't survive it
+    webserver.load()
+    # Moves everything loaded so far out of the collector's reach, so collections
+    # in the workers don't write to (and un-share) the pages it's on
+    gc.collect()
+    gc.freeze()
+
+    children: Set[int] = set()
+    stopping = False
+
+    def spawn():
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            try:
+                serve_worker(webserver.app, sock, threads_per_worker)
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+            # Skips the parent's atexit handlers and buffered state
+            os._exit(0)
+        children.add(pid)
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for _ in range(workers):
+        spawn()
+    print(f"Serving on {host}:{port} with {workers} workers", file=sys.stderr)
+    while children:
+        pid, status = os.wait()
+        children.discard(pid)
+        if not stopping:
+            print(
+                f"Worker {pid} exited with status {status}, restarting",
+                file=sys.stderr,
+            )
+            time.sleep(1)
+            spawn()
+
+
+if __name__ == "__main__":
+    cpus = len(os.sched_getaffinity(0))
+    vector_index_dir = os.getenv("HNSS_VECTOR_INDEX_DIR")
+    parser = argparse.ArgumentParser(
+        description="Serve webserver.app from several processes sharing one model and index"  # noqa: E501
+    )
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=int(os.getenv("HNSS_WORKERS", str(cpus if vector_index_dir else 1))),
+        help="Number of worker processes (defaults to the number of CPUs with HNSS_VECTOR_INDEX_DIR, otherwise 1)",  # noqa: E501
+    )
+    parser.add_argument(
+        "--threads-per-worker",
+        type=int,
+        default=0,
+        help="Model threads per worker (defaults to the CPUs divided between workers). onnxruntime's are started before forking, so its forked workers use one.",  # noqa: E501
+    )
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+    if args.workers > 1 and not vector_index_dir:
+        # Chroma's client isn't fork-safe, and each worker would load its own copy
+        # of the HNSW index anyway
+        parser.error("--workers > 1 requires HNSS_VECTOR_INDEX_DIR (a MatrixIndex)")
+
+    serve(
+        args.host,
+        args.port,
+        args.workers,
+        args.threads_per_worker or max(1, cpus // args.workers),
+    )
@@ -0,0 +1,107 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List
+
+from feed_refresher import FeedRefresher
+from git_to_jsonl import HNEntry
+
+
+def feed_item(i: int) -> str:
+    description = (
+        f'<p>Score {i} | Comments {i} (<a href="https://news.ycombinator.com/item?id={i}">HN</a>)</p>'  # noqa: E501
+        f"<!-- hnss:readable-content --><hr/><p>Text of entry {i}</p>"
+    )
+    return (
+        f"<item><title>Entry {i}</title><link>https://example.com/{i}</link>"
+        f"<guid>hacker-news-small-sites-{i}</guid>"
+        f"<pubDate>Wed, 01 Jan 2020 00:0{i}:00 GMT</pubDate>"
+        f"<description><![CDATA[{description}]]></description></item>"
+    )
+
+
+def feed(items: List[int]) -> bytes:
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel>'
+        + "".join(feed_item(i) for i in items)
+        + "</channel></rss>"
+    ).encode("utf-8")
+
+
+class FeedServer(ThreadingHTTPServer):
+    """Serves `body` with `etag`, and a 304 to requests that already have it."""
+
+    def __init__(self):
+        self.body = b""
+        self.etag = ""
+        self.statuses: List[int] = []
+        super().__init__(("127.0.0.1", 0), FeedHandler)
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    server: FeedServer
+
+    def do_GET(self):
+        if self.headers.get("If-None-Match") == self.server.etag:
+            self.server.statuses.append(304)
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.server.statuses.append(200)
+        self.send_response(200)
+        self.send_header("ETag", self.server.etag)
+        self.send_header("Content-Length", str(len(self.server.body)))
+        self.end_headers()
+        self.wfile.write(self.server.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FeedRefresherTest(unittest.TestCase):
+    def setUp(self):
+        self.server = FeedServer()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.new_entries: List[List[HNEntry]] = []
+        self.refresher = FeedRefresher(
+            f"http://127.0.0.1:{self.server.server_port}/feed.xml",
+            on_new_entries=self.new_entries.append,
+        )
+
+    def guids(self) -> List[str]:
+        assert self.refresher.entries is not None
+        return [e.guid for e in self.refresher.entries]
+
+    def test_unchanged_feed_is_not_downloaded_again(self):
+        self.server.body, self.server.etag = feed([2, 1]), '"v1"'
+        self.assertTrue(self.refresher.refresh())
+        self.assertFalse(self.refresher.refresh())
+        self.assertEqual(self.server.statuses, [200, 304])
+        self.assertEqual(
+            self.guids(), ["hacker-news-small-sites-2", "hacker-news-small-sites-1"]
+        )
+        self.assertEqual(len(self.new_entries), 1)
+
+    def test_only_new_items_are_processed(self):
+        self.server.body, self.server.etag = feed([2, 1]), '"v1"'
+        self.refresher.refresh()
+        self.server.body, self.server.etag = feed([3, 2]), '"v2"'
+        self.assertTrue(self.refresher.refresh())
+        self.assertEqual(self.server.statuses, [200, 200])
+        self.assertEqual(
+            self.guids(), ["hacker-news-small-sites-3", "hacker-news-small-sites-2"]
+        )
+        self.assertEqual(
+            [[e.guid for e in entries] for entries in self.new_entries],
+            [
+                ["hacker-news-small-sites-2", "hacker-news-small-sites-1"],
+                ["hacker-news-small-sites-3"],
+            ],
+        )
+        self.assertEqual(self.new_entries[1][0].text, "<p>Text of entry 3</p>")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+import argparse
+import sqlite3
+import time
+from typing import Iterable, List, Tuple
+
+import html2text
+
+from parallel import bounded_imap
+
+# Rows read from `documents` and written to the index at once by build_text_index
+_BATCH_SIZE = 1024
+
+_SELECT_DOCUMENTS = """
+    SELECT documents.rowid, documents.title, document_texts.text FROM documents
+    JOIN document_texts ON document_texts.rowid = documents.rowid
+"""
+
+
+def create_text_index(db_client: sqlite3.Connection):
+    """
+    A full-text index over each document's title and readable text, keyed by the
+    `documents` rowid. It's contentless (the text isn't stored twice), so it can
+    only be used to find rowids, and is rebuilt rather than updated in place.
+    """
+    db_client.execute(
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+            title, text, content='', tokenize='unicode61 remove_diacritics 2'
+        )
+    """
+    )
+
+
+def readable_row(row: Tuple[int, str, str]) -> Tuple[int, str, str]:
+    """(rowid, title, HTML) -> (rowid, title, text) for the index."""
+    rowid, title, html = row
+    return rowid, title, html2text.html2text(html)
+
+
+def index_documents(
+    db_client: sqlite3.Connection, rows: Iterable[Tuple[int, str, str]]
+):
+    db_client.executemany(
+        "INSERT INTO documents_fts (rowid, title, text) VALUES (?, ?, ?)", rows
+    )
+
+
+def index_new_documents(db_client: sqlite3.Connection, last_rowid: int):
+    """Indexes every document inserted after `last_rowid`, in-process."""
+    cursor = db_client.execute(
+        f"{_SELECT_DOCUMENTS} WHERE documents.rowid > ?", (last_rowid,)
+    )
+    index_documents(db_client, map(readable_row, cursor))
+
+
+def build_text_index(data_db: str, workers: int = 0):
+    db_client = sqlite3.connect(data_db)
+    db_client.execute("PRAGMA journal_mode=WAL")
+    with db_client:
+        db_client.execute("DROP TABLE IF EXISTS documents_fts")
+        create_text_index(db_client)
+    # A second connection, so the read isn't disturbed by the writes
+    read_client = sqlite3.connect(data_db)
+    rows = read_client.execute(_SELECT_DOCUMENTS)
+    start = time.monotonic()
+    count = 0
+    batches = iter(lambda: rows.fetchmany(_BATCH_SIZE), [])
+    for batch in bounded_imap(_readable_rows, batches, workers):
+        with db_client:
+            index_documents(db_client, batch)
+        count += len(batch)
+        elapsed = time.monotonic() - start
+        print(f"Indexed {count} documents ({count / elapsed:.1f} docs/s)", end="\r")
+    with db_client:
+        db_client.execute(
+            "INSERT INTO documents_fts (documents_fts) VALUES ('optimize')"
+        )
+    print(f"Indexed {count} documents in {time.monotonic() - start:.1f}s")
+
+
+def _readable_rows(rows: List[Tuple[int, str, str]]) -> List[Tuple[int, str, str]]:
+    return list(map(readable_row, rows))
+
+
+def fts_query(query: str) -> str:
+    """
+    Quotes each term, so user input can't be parsed as FTS5 syntax. Terms are
+    ANDed, as in most search boxes.
+    """
+    return " ".join('"' + t.replace('"', '""') + '"' for t in query.split())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="(Re)build the full-text index of a data.db ingested with chroma-ingest.py"  # noqa: E501
+    )
+    parser.add_argument("data_db", help="Path to the data.db file")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Number of worker processes to convert HTML to text in (0 converts in-process)",  # noqa: E501
+    )
+    args = parser.parse_args()
+
+    build_text_index(args.data_db, workers=args.workers)
@@ -0,0 +1,371 @@
+import argparse
+import json
+import os
+from typing import Collection, Dict, Iterator, List, Tuple
+
+import numpy as np
+
+from embeddings_file import iter_embeddings
+from quantization import ProductQuantizer, assign, kmeans, quantize_int8
+
+# Rows scored per matrix multiply, to bound temporary memory while scanning
+_SCAN_BLOCK_ROWS = 1 << 14
+
+
+class MatrixIndex:
+    """
+    Read-only vector index over memory-mapped embeddings, for serving search
+    without Chroma. Queries scan every row with NumPy (exact), or only the
+    `nprobe` nearest IVF clusters if the index was built with `--nlist`.
+    Distances are squared L2, the same as Chroma's default.
+
+    If the index was built with `--quantization`, rows are scored from their int8
+    or PQ codes, and the best `num_results * rerank` are re-scored at full
+    precision from `vectors.bin` (if it hasn't been deleted to save disk).
+
+    With `document_ids`, only those documents' rows are scored. If the probed IVF
+    clusters don't hold enough of them, every one of them is.
+
+    Chunks added with `upsert` (e.g. by live_ingest.py, for documents ingested
+    since the index was built) are kept in memory and always scanned exactly.
+    """
+
+    def __init__(
+        self, index_dir: str, nprobe: int = 16, exact: bool = False, rerank: int = 4
+    ):
+        with open(os.path.join(index_dir, "meta.json"), "r") as file:
+            meta = json.load(file)
+        count, dim = meta["count"], meta["dim"]
+        self.quantization = meta.get("quantization", "none")
+        self.vectors = None
+        vectors_path = os.path.join(index_dir, "vectors.bin")
+        if os.path.exists(vectors_path):
+            self.vectors = np.memmap(
+                vectors_path, dtype=np.float32, mode="r", shape=(count, dim)
+            )
+        self.codes = None
+        self.scales = None
+        self.pq = None
+        if self.quantization == "int8":
+            self.codes = np.memmap(
+                os.path.join(index_dir, "codes.bin"),
+                dtype=np.int8,
+                mode="r",
+                shape=(count, dim),
+            )
+            self.scales = np.fromfile(os.path.join(index_dir, "scales.bin"), np.float32)
+        elif self.quantization == "pq":
+            self.pq = ProductQuantizer(
+                np.load(os.path.join(index_dir, "pq_codebooks.npy"))
+            )
+            self.codes = np.memmap(
+                os.path.join(index_dir, "codes.bin"),
+                dtype=np.uint8,
+                mode="r",
+                shape=(count, len(self.pq.codebooks)),
+            )
+        elif self.vectors is None:
+            raise FileNotFoundError(vectors_path)
+        self.norms = np.fromfile(os.path.join(index_dir, "norms.bin"), np.float32)
+        # (document index, chunk index) of each row
+        self.rows = np.fromfile(os.path.join(index_dir, "rows.bin"), np.int32)
+        self.rows = self.rows.reshape(count, 2)
+        with open(os.path.join(index_dir, "documents.json"), "r") as file:
+            self.documents: List[str] = json.load(file)
+        self.centroids = None
+        self.offsets = None
+        if meta.get("nlist"):
+            self.centroids = np.load(os.path.join(index_dir, "centroids.npy"))
+            self.offsets = np.load(os.path.join(index_dir, "offsets.npy"))
+        self.nprobe = nprobe
+        self.exact = exact
+        self.rerank = rerank
+        # Document id -> index in self.documents, built on the first filtered query
+        self._document_positions: Dict[str, int] | None = None
+        # (embedding ids, vectors) of upserted chunks, replaced rather than updated
+        # in place so concurrent queries always see a consistent pair
+        self._live: Tuple[List[str], np.ndarray] = ([], np.empty((0, dim), np.float32))
+
+    def query(
+        self,
+        embedding: List[float],
+        num_results: int,
+        document_ids: Collection[str] | None = None,
+    ) -> Tuple[List[str], List[float]]:
+        q = np.asarray(embedding, dtype=np.float32)
+        probing = (
+            self.centroids is not None and self.offsets is not None and not self.exact
+        )
+        if probing:
+            centroid_distances = np.square(self.centroids - q).sum(axis=1)
+            probes = np.argsort(centroid_distances)[: self.nprobe]
+            ranges = [(self.offsets[c], self.offsets[c + 1]) for c in probes]
+        else:
+            ranges = [(0, len(self.rows))]
+        blocks: List[slice | np.ndarray] = [
+            slice(block_start, min(block_start + _SCAN_BLOCK_ROWS, stop))
+            for start, stop in ranges
+            for block_start in range(start, stop, _SCAN_BLOCK_ROWS)
+        ]
+        if document_ids is not None:
+            allowed = self._allowed_rows(document_ids)
+            rows = np.sort(
+                np.concatenate([np.arange(start, stop) for start, stop in ranges])
+            )
+            rows = rows[allowed[rows]]
+            if probing and len(rows) < num_results:
+                rows = np.flatnonzero(allowed)
+            blocks = [
+                rows[start : start + _SCAN_BLOCK_ROWS]
+                for start in range(0, len(rows), _SCAN_BLOCK_ROWS)
+            ]
+        if self.quantization == "none":
+            rows, distances = self._scan(q, blocks, num_results)
+        elif self.vectors is not None and self.rerank > 0:
+            candidates, _ = self._scan(q, blocks, num_results * self.rerank)
+            candidates = np.sort(candidates)  # Sequential reads from vectors.bin
+            distances = np.square(self.vectors[candidates] - q).sum(axis=1)
+            top = _top_k(distances, num_results)
+            order = top[np.argsort(distances[top])]
+            rows, distances = candidates[order], distances[order]
+        else:
+            rows, distances = self._scan(q, blocks, num_results)
+        ids = [self._row_id(r) for r in rows]
+        live_ids, live_vectors = self._live
+        if not live_ids:
+            return ids, distances.tolist()
+        live_rows = np.arange(len(live_ids))
+        if document_ids is not None:
+            live_rows = live_rows[
+                [id.rpartition(":")[0] in document_ids for id in live_ids]
+            ]
+        live_distances = np.square(live_vectors[live_rows] - q).sum(axis=1)
+        all_ids = ids + [live_ids[r] for r in live_rows]
+        all_distances = np.concatenate([distances, live_distances])
+        order = np.argsort(all_distances, kind="stable")[:num_results]
+        return [all_ids[i] for i in order], all_distances[order].tolist()
+
+    def count(self) -> int:
+        return len(self.rows) + len(self._live[0])
+
+    def upsert(self, ids: List[str], embeddings: List[List[float]]):
+        """
+        Adds chunks to the in-memory segment, replacing any with the same id.
+        Chunks of documents that are already in the index are ignored, so they
+        aren't returned twice once it's been rebuilt to include them.
+        """
+        if self._document_positions is None:
+            self._document_positions = {id: i for i, id in enumerate(self.documents)}
+        live_ids, live_vectors = self._live
+        # Insertion-ordered, so a replaced chunk keeps its row
+        live: Dict[str, np.ndarray] = dict(zip(live_ids, live_vectors))
+        for id, embedding in zip(ids, embeddings):
+            if id.rpartition(":")[0] not in self._document_positions:
+                live[id] = np.asarray(embedding, dtype=np.float32)
+        if live:
+            self._live = (list(live), np.stack(list(live.values())))
+
+    def _row_id(self, row: int) -> str:
+        document, chunk = self.rows[row]
+        return f"{self.documents[document]}:{chunk}"
+
+    def _allowed_rows(self, document_ids: Collection[str]) -> np.ndarray:
+        if self._document_positions is None:
+            self._document_positions = {id: i for i, id in enumerate(self.documents)}
+        allowed_documents = np.zeros(len(self.documents), dtype=bool)
+        allowed_documents[
+            [
+                self._document_positions[id]
+                for id in document_ids
+                if id in self._document_positions
+            ]
+        ] = True
+        return allowed_documents[self.rows[:, 0]]
+
+    def _block_distances(self, q: np.ndarray, rows: slice | np.ndarray) -> np.ndarray:
+        """`rows` is a contiguous slice, or sorted row numbers when filtering."""
+        if self.pq is not None and self.codes is not None:
+            return self.pq.distances(self.pq.distance_table(q), self.codes[rows])
+        if self.codes is not None and self.scales is not None:
+            dots = (self.codes[rows] @ q) * self.scales[rows]
+        else:
+            assert self.vectors is not None
+            dots = self.vectors[rows] @ q
+        return self.norms[rows] - 2 * dots + q @ q
+
+    def _scan(
+        self, q: np.ndarray, blocks: List[slice | np.ndarray], k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        best_rows = np.empty(0, dtype=np.int64)
+        best_distances = np.empty(0, dtype=np.float32)
+        for block in blocks:
+            distances = self._block_distances(q, block)
+            top = _top_k(distances, k)
+            rows = top + block.start if isinstance(block, slice) else block[top]
+            best_rows = np.concatenate([best_rows, rows])
+            best_distances = np.concatenate([best_distances, distances[top]])
+            top = _top_k(best_distances, k)
+            best_rows, best_distances = best_rows[top], best_distances[top]
+        order = np.argsort(best_distances)
+        return best_rows[order], best_distances[order]
+
+
+def _top_k(distances: np.ndarray, k: int) -> np.ndarray:
+    if len(distances) <= k:
+        return np.arange(len(distances))
+    return np.argpartition(distances, k)[:k]
+
+
+def _iter_blocks(count: int) -> Iterator[Tuple[int, int]]:
+    for start in range(0, count, _SCAN_BLOCK_ROWS):
+        yield start, min(start + _SCAN_BLOCK_ROWS, count)
+
+
+def _sample(vectors: np.ndarray, sample_size: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    rows = rng.choice(len(vectors), min(sample_size, len(vectors)), replace=False)
+    return np.asarray(vectors[np.sort(rows)])
+
+
+def train_ivf(
+    vectors: np.ndarray, nlist: int, sample_size: int, iterations: int, seed: int = 0
+) -> np.ndarray:
+    return kmeans(
+        _sample(vectors, sample_size, seed),
+        nlist,
+        iterations,
+        np.random.default_rng(seed),
+    )
+
+
+def build_index(
+    embeddings_path: str,
+    index_dir: str,
+    nlist: int = 0,
+    sample_size: int = 100_000,
+    iterations: int = 10,
+    quantization: str = "none",
+    pq_subvectors: int = 48,
+):
+    os.makedirs(index_dir, exist_ok=True)
+    vectors_path = os.path.join(index_dir, "vectors.bin")
+    rows_path = os.path.join(index_dir, "rows.bin")
+    documents: List[str] = []
+    seen_documents = set()
+    count, dim = 0, 0
+    with open(vectors_path, "wb") as file_vectors:
+        with open(rows_path, "wb") as file_rows:
+            for id, embeddings in iter_embeddings(embeddings_path):
+                # Like Chroma's add(), the first copy of a duplicated id wins
+                if not len(embeddings) or id in seen_documents:
+                    continue
+                seen_documents.add(id)
+                # A no-op for float32 binary files, which are read as memmap views
+                matrix = np.asarray(embeddings, dtype=np.float32)
+                rows = np.empty((len(matrix), 2), dtype=np.int32)
+                rows[:, 0] = len(documents)
+                rows[:, 1] = np.arange(len(matrix))
+                documents.append(id)
+                file_vectors.write(matrix.tobytes())
+                file_rows.write(rows.tobytes())
+                count += len(matrix)
+                dim = matrix.shape[1]
+
+    vectors = np.memmap(vectors_path, dtype=np.float32, mode="r", shape=(count, dim))
+    rows = np.fromfile(rows_path, np.int32).reshape(count, 2)
+    nlist = min(nlist, count)
+    if nlist:
+        centroids = train_ivf(vectors, nlist, sample_size, iterations)
+        assignments = assign(vectors, centroids)
+        # Store each cluster's rows contiguously, so probing a cluster is a slice
+        order = np.argsort(assignments, kind="stable")
+        clustered_path = os.path.join(index_dir, "vectors.bin.tmp")
+        with open(clustered_path, "wb") as file_vectors:
+            for start, stop in _iter_blocks(count):
+                file_vectors.write(vectors[order[start:stop]].tobytes())
+        del vectors
+        os.replace(clustered_path, vectors_path)
+        vectors = np.memmap(
+            vectors_path, dtype=np.float32, mode="r", shape=(count, dim)
+        )
+        rows = rows[order]
+        rows.tofile(rows_path)
+        offsets = np.searchsorted(assignments[order], np.arange(nlist + 1))
+        np.save(os.path.join(index_dir, "centroids.npy"), centroids)
+        np.save(os.path.join(index_dir, "offsets.npy"), offsets)
+
+    norms = np.empty(count, dtype=np.float32)
+    for start, stop in _iter_blocks(count):
+        norms[start:stop] = np.square(vectors[start:stop]).sum(axis=1)
+    norms.tofile(os.path.join(index_dir, "norms.bin"))
+
+    if quantization == "int8":
+        with open(os.path.join(index_dir, "codes.bin"), "wb") as file_codes:
+            with open(os.path.join(index_dir, "scales.bin"), "wb") as file_scales:
+                for start, stop in _iter_blocks(count):
+                    codes, scales = quantize_int8(vectors[start:stop])
+                    file_codes.write(codes.tobytes())
+                    file_scales.write(scales.tobytes())
+    elif quantization == "pq":
+        pq = ProductQuantizer.train(
+            _sample(vectors, sample_size), pq_subvectors, iterations
+        )
+        np.save(os.path.join(index_dir, "pq_codebooks.npy"), pq.codebooks)
+        with open(os.path.join(index_dir, "codes.bin"), "wb") as file_codes:
+            for start, stop in _iter_blocks(count):
+                file_codes.write(pq.encode(np.asarray(vectors[start:stop])).tobytes())
+
+    with open(os.path.join(index_dir, "documents.json"), "w") as file:
+        json.dump(documents, file)
+    with open(os.path.join(index_dir, "meta.json"), "w") as file:
+        json.dump(
+            {"count": count, "dim": dim, "nlist": nlist, "quantization": quantization},
+            file,
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build a MatrixIndex from an embeddings file"
+    )
+    parser.add_argument(
+        "embeddings_path",
+        help="Path to an embeddings file (or --format binary directory) generated with entries-to-embeddings.py",  # noqa: E501
+    )
+    parser.add_argument("index_dir", help="Directory to write the index to")
+    parser.add_argument(
+        "--nlist",
+        type=int,
+        default=0,
+        help="Number of IVF clusters for approximate search (0 only supports exact search)",  # noqa: E501
+    )
+    parser.add_argument(
+        "--sample-size",
+        type=int,
+        default=100_000,
+        help="Number of vectors to train the IVF clusters and PQ codebooks on",
+    )
+    parser.add_argument("--iterations", type=int, default=10, help="k-means iterations")
+    parser.add_argument(
+        "--quantization",
+        choices=["none", "int8", "pq"],
+        default="none",
+        help="Score rows from int8 or product quantized codes, re-ranking the best at full precision",  # noqa: E501
+    )
+    parser.add_argument(
+        "--pq-subvectors",
+        type=int,
+        default=48,
+        help="Bytes per vector with --quantization pq (must divide the dimension)",
+    )
+    args = parser.parse_args()
+
+    build_index(
+        args.embeddings_path,
+        args.index_dir,
+        nlist=args.nlist,
+        sample_size=args.sample_size,
+        iterations=args.iterations,
+        quantization=args.quantization,
+        pq_subvectors=args.pq_subvectors,
+    )
@@ -1,56 +1,316 @@
 import asyncio
+import cProfile
+import io
+import logging
 import os
-from contextlib import asynccontextmanager
-from datetime import datetime
-from email.utils import parsedate_to_datetime
-from functools import lru_cache
-from typing import cast
+import pstats
+import random
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, closing
+from datetime import datetime, timezone
+from typing import Dict, List, Set, Tuple, cast
 
-import feedparser
 from cachetools import TTLCache, cached
-from fastapi import FastAPI, Request
-from fastapi.responses import HTMLResponse
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import HTMLResponse, PlainTextResponse
 from fastapi.templating import Jinja2Templates
 
-from chroma_query import QueryEngine
-from git_to_jsonl import FeedItem, process_feed_item
+from chroma_query import (
+    AggregationRule,
+    ChunkAggregation,
+    HNSSEntryMetadata,
+    QueryEngine,
+    QueryResultMetadata,
+    SearchMode,
+    fuse_results,
+    group_by_document,
+)
+from documents_db import DocumentFilters
+from embedding_models import MODEL_NAME, QueryEmbeddingBatcher, get_embedder
+from feed_refresher import FEED_URL, FeedRefresher
+from metrics import Registry, StageTimer
+from query_cache import QueryCache, SearchResults, normalize_query
+from vector_index import MatrixIndex
 
+logger = logging.getLogger(__name__)
 templates = Jinja2Templates(directory="web-templates")
 
-query_engine = QueryEngine(
-    data_db=os.getenv("HNSS_DATA_DB", "data.db"),
-    chroma_dir=os.getenv("HNSS_CHROMA_DIR", "./chroma"),
+data_db = os.getenv("HNSS_DATA_DB", "data.db")
+vector_index_dir = os.getenv("HNSS_VECTOR_INDEX_DIR")
+# Queries arriving within this many ms of each other are embedded together
+query_batch_window_ms = float(os.getenv("HNSS_QUERY_BATCH_WINDOW_MS", "5"))
+# ...up to this many at once
+query_batch_size = int(os.getenv("HNSS_QUERY_BATCH_SIZE", "16"))
+
+# Loading the model takes seconds, so it's done in the background after the
+# server starts (or up front by serve.py) rather than on import. /ready reports
+# whether it's done, and requests are turned away until then.
+query_engine: QueryEngine | None = None
+query_engine_lock = threading.Lock()
+ready = threading.Event()
+# Whether data.db has the index that text and hybrid search need
+text_index_available = False
+
+
+def load() -> QueryEngine:
+    global query_engine
+    with query_engine_lock:
+        if query_engine is None:
+            query_batcher = (
+                QueryEmbeddingBatcher(
+                    get_embedder()[0],
+                    window_ms=query_batch_window_ms,
+                    max_batch_size=query_batch_size,
+                )
+                if query_batch_window_ms > 0
+                else None
+            )
+            query_engine = QueryEngine(
+                data_db=data_db,
+                chroma_dir=os.getenv("HNSS_CHROMA_DIR", "./chroma"),
+                vector_backend=(
+                    MatrixIndex(vector_index_dir) if vector_index_dir else None
+                ),
+                embed_query=query_batcher.embed_query if query_batcher else None,
+            )
+        return query_engine
+
+
+def warm_up():
+    global text_index_available
+    # The first forward pass and the first reads of the index and documents DB are
+    # much slower than the rest, so they're paid for before reporting ready
+    engine = load()
+    embedding = engine.embed_query("warm up")
+    engine.vector_backend.query(embedding, 1)
+    cached_doc_count()
+    cached_embedding_count()
+    text_index_available = engine.has_text_index()
+    if live_ingester:
+        live_ingester.start(engine.vector_backend, engine.embedder.embed_documents)
+    ready.set()
+
+
+QueryResults = List[Tuple[HNSSEntryMetadata, List[QueryResultMetadata]]]
+
+# Searches are CPU-bound, so they run on a pool instead of the event loop. Workers
+# spend most of their time waiting on query_batcher, so by default there are as
+# many as fit in a batch, or no batch could fill before its window ends. Past
+# max_pending_searches distinct searches in flight, new ones are turned away
+# rather than queued behind work that will miss its deadline.
+search_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("HNSS_SEARCH_WORKERS", str(query_batch_size))),
+    thread_name_prefix="search",
+)
+max_pending_searches = int(os.getenv("HNSS_MAX_PENDING_SEARCHES", "32"))
+pending_searches: Dict[
+    Tuple[str, SearchMode, DocumentFilters],
+    "asyncio.Future[Tuple[QueryResults, Dict[str, float]]]",
+] = {}
+query_cache = QueryCache(
+    max_bytes=int(os.getenv("HNSS_QUERY_CACHE_BYTES", str(64 * 1024 * 1024))),
+    model_name=MODEL_NAME,
+    db_path=os.getenv("HNSS_QUERY_CACHE_DB"),
+    max_db_rows=int(os.getenv("HNSS_QUERY_CACHE_DB_ROWS", "50000")),
+)
+# With HNSS_LIVE_INGEST, new feed items are embedded and added to the index as
+# they're seen, instead of waiting for the next offline rebuild. It's only imported
+# then, since preprocessing entries needs llama-index, which serving doesn't.
+live_ingester = None
+if os.getenv("HNSS_LIVE_INGEST"):
+    from live_ingest import LiveIngester
+
+    live_ingester = LiveIngester(
+        data_db,
+        batch_size=int(os.getenv("HNSS_LIVE_INGEST_BATCH_SIZE", "16")),
+        max_per_minute=int(os.getenv("HNSS_LIVE_INGEST_MAX_PER_MINUTE", "60")),
+    )
+# Shown on the front page, and refreshed every minute by app_lifespan
+feed_refresher = FeedRefresher(
+    os.getenv("HNSS_FEED_URL", FEED_URL),
+    on_new_entries=live_ingester.submit if live_ingester else None,
+)
+
+
+# Served on /metrics. Stages are timed separately so a slow request can be traced
+# to the model (embed), the vector backend (vector_search) or SQLite (cache with
+# HNSS_QUERY_CACHE_DB, filter, text_search, hydrate).
+metrics = Registry()
+request_seconds = metrics.histogram(
+    "hnss_request_seconds", "Time to handle a request", ("path",)
+)
+requests_total = metrics.counter(
+    "hnss_requests_total", "Requests handled", ("path", "status")
 )
+stage_seconds = metrics.histogram(
+    "hnss_stage_seconds", "Time spent in each stage of a search", ("stage",)
+)
+query_cache_requests = metrics.counter(
+    "hnss_query_cache_requests_total",
+    "Query cache lookups by cache and result",
+    ("cache", "result"),
+)
+metrics.gauge(
+    "hnss_pending_searches",
+    "Distinct searches in progress",
+    lambda: len(pending_searches),
+)
+# The fraction of searches to run under cProfile. Profiles are written to
+# HNSS_PROFILE_DIR if it's set, and otherwise logged.
+profile_sample_rate = float(os.getenv("HNSS_PROFILE_SAMPLE_RATE", "0"))
+profile_dir = os.getenv("HNSS_PROFILE_DIR")
 
+# Distinct documents per search, and how they're scored from their chunks
+num_results = int(os.getenv("HNSS_NUM_RESULTS", "30"))
+chunk_aggregation = ChunkAggregation(
+    rule=cast(AggregationRule, os.getenv("HNSS_CHUNK_AGGREGATION", "min")),
+    top_n=int(os.getenv("HNSS_CHUNK_AGGREGATION_TOP_N", "3")),
+)
 
-@lru_cache
-def cached_query(query: str):
-    return list(query_engine.query(query, num_results=80))
 
+def results_key(key: str, filters: DocumentFilters) -> str:
+    # Includes the settings, since the cache DB can outlive them
+    return f"{key}\n{num_results} {chunk_aggregation!r} {filters!r}"
 
-@cached(TTLCache(1, ttl=3600))
-def cached_doc_count():
-    return query_engine.count_documents()
+
+@cached(TTLCache(32, ttl=60), lock=threading.Lock())
+def cached_filter_documents(filters: DocumentFilters) -> Set[str]:
+    return load().filter_documents(filters)
 
 
-@cached(TTLCache(1, ttl=3600))
-def cached_feed():
-    feed = feedparser.parse(
-        "https://raw.githubusercontent.com/awendland/hacker-news-small-sites/generated/feeds/hn-small-sites-score-1.xml"
+def vector_search(
+    key: str, filters: DocumentFilters, timer: StageTimer
+) -> SearchResults:
+    # Cached results are invalidated by an ingest changing the number of chunks in
+    # this process's vector backend (live ingests only count once synced to it)
+    generation = cached_embedding_count()
+    with timer.stage("cache"):
+        results = query_cache.get_results(results_key(key, filters), generation)
+    query_cache_requests.inc(
+        cache="results", result="miss" if results is None else "hit"
     )
-    return [
-        process_feed_item(
-            FeedItem(
-                guid=e.guid,
-                title=e.title,
-                link=e.link,
-                pub_date=parsedate_to_datetime(e.published),
-                description=e.summary,
-                last_source_commit=cast(str, None),
+    if results is None:
+        # The same query with different filters has the same embedding
+        with timer.stage("cache"):
+            embedding = query_cache.get_embedding(key)
+        query_cache_requests.inc(
+            cache="embedding", result="miss" if embedding is None else "hit"
+        )
+        if embedding is None:
+            with timer.stage("embed"):
+                embedding = load().embed_query(key)
+            query_cache.put_embedding(key, embedding)
+        document_ids = None
+        if filters:
+            with timer.stage("filter"):
+                document_ids = cached_filter_documents(filters)
+        with timer.stage("vector_search"):
+            doc_results = load().search_vectors(
+                embedding, num_results, document_ids, chunk_aggregation
             )
+        # Flattened in document order, which group_by_document() keeps
+        chunks = [c for cs in doc_results.values() for c in cs]
+        results = [c["embedding_id"] for c in chunks], [c["distance"] for c in chunks]
+        query_cache.put_results(results_key(key, filters), generation, results)
+    return results
+
+
+def run_query(
+    key: str, mode: SearchMode, filters: DocumentFilters, profile: bool = False
+) -> Tuple[QueryResults, Dict[str, float]]:
+    """The search's results, and the seconds spent in each of its stages."""
+    timer = StageTimer(stage_seconds)
+    # Only this thread is profiled, so with query batching the forward pass shows
+    # up as waiting on the batcher's thread
+    profiler = cProfile.Profile() if profile else None
+    if profiler:
+        profiler.enable()
+    try:
+        vector_results = (
+            group_by_document(*vector_search(key, filters, timer))
+            if mode != "text"
+            else {}
         )
-        for e in feed.entries
-    ]
+        # Full-text search is cheap enough not to cache
+        text_ids = []
+        if mode != "vector":
+            with timer.stage("text_search"):
+                text_ids = load().search_text(key, num_results, filters)
+        with timer.stage("hydrate"):
+            results = list(
+                load().hydrate(
+                    fuse_results(vector_results, text_ids), include_text=False
+                )
+            )
+    finally:
+        if profiler:
+            profiler.disable()
+            save_profile(profiler, key)
+    return results, timer.seconds
+
+
+def save_profile(profiler: cProfile.Profile, key: str):
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        path = os.path.join(profile_dir, f"search-{time.time_ns()}-{os.getpid()}.prof")
+        profiler.dump_stats(path)
+        logger.info(f"Profiled search {key!r} to {path}")
+    else:
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats("cumulative").print_stats(20)
+        logger.info(f"Profiled search {key!r}:\n{stream.getvalue()}")
+
+
+async def search(
+    query: str, mode: SearchMode, filters: DocumentFilters
+) -> Tuple[QueryResults, Dict[str, float]]:
+    key = normalize_query(query)
+    # Identical concurrent searches share a single computation
+    future = pending_searches.get((key, mode, filters))
+    if future is None:
+        # Cache hits are cheap, so only misses are turned away. Text searches
+        # don't read the results cache, so they're never hits. The generation is
+        # read without awaiting, so identical searches can't both get here.
+        if len(pending_searches) >= max_pending_searches and (
+            mode == "text"
+            or not query_cache.has_results(
+                results_key(key, filters), cached_embedding_count()
+            )
+        ):
+            raise HTTPException(
+                status_code=503,
+                detail="Too many searches in progress, please try again",
+                headers={"Retry-After": "1"},
+            )
+        future = asyncio.get_running_loop().run_in_executor(
+            search_executor,
+            run_query,
+            key,
+            mode,
+            filters,
+            random.random() < profile_sample_rate,
+        )
+        pending_searches[key, mode, filters] = future
+        future.add_done_callback(
+            lambda _: pending_searches.pop((key, mode, filters), None)
+        )
+    # A disconnecting client shouldn't cancel a search others are waiting on
+    return await asyncio.shield(future)
+
+
+@cached(TTLCache(1, ttl=60), lock=threading.Lock())
+def cached_doc_count():
+    # Counted without load(), so the front page doesn't wait for the model
+    with closing(sqlite3.connect(data_db)) as db_client:
+        return db_client.execute("SELECT COUNT(*) FROM documents").fetchone()[0]
+
+
+@cached(TTLCache(1, ttl=60), lock=threading.Lock())
+def cached_embedding_count():
+    return load().count_embeddings()
 
 
 @asynccontextmanager
@@ -58,41 +318,132 @@ async def app_lifespan(app: FastAPI):
     async def cache_refresher():
         try:
             while True:
-                cached_feed()
+                try:
+                    # urllib fetches synchronously, so keep it off the event loop
+                    await asyncio.to_thread(feed_refresher.refresh)
+                except Exception:
+                    logger.exception("Failed to refresh the feed")
                 await asyncio.sleep(1 * 60)
         except asyncio.CancelledError:
             pass
 
-    task = asyncio.create_task(cache_refresher())
+    async def start():
+        try:
+            await asyncio.to_thread(warm_up)
+        except Exception:
+            logger.exception("Failed to load the query engine")
+
+    # Held so they aren't garbage collected while running
+    tasks = [asyncio.create_task(start()), asyncio.create_task(cache_refresher())]
     yield
-    task.cancel()
-    await task
+    if live_ingester:
+        live_ingester.stop()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 
 app = FastAPI(lifespan=app_lifespan)
 
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    # Unknown paths share a label, so scanners can't add a series per path
+    path = request.url.path
+    if path not in {"/", "/ready", "/metrics"}:
+        path = "other"
+    start = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        request_seconds.observe(time.perf_counter() - start, path=path)
+        requests_total.inc(path=path, status=status)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def read_metrics():
+    return PlainTextResponse(
+        metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/ready")
+async def read_ready():
+    if not ready.is_set():
+        raise HTTPException(
+            status_code=503, detail="Loading", headers={"Retry-After": "1"}
+        )
+    return {"status": "ready"}
+
+
 @app.get("/", response_class=HTMLResponse)
-async def read_item(request: Request, query: str | None = None):
+async def read_item(
+    request: Request,
+    query: str | None = None,
+    mode: SearchMode = "vector",
+    # Strings rather than int/date, since the search form submits empty fields
+    min_score: str | None = None,
+    since: str | None = None,
+    domain: str | None = None,
+):
+    try:
+        filters = DocumentFilters(
+            min_score=int(min_score) if min_score else None,
+            since=(
+                datetime.fromisoformat(since).replace(tzinfo=timezone.utc)
+                if since
+                else None
+            ),
+            domain=(domain.strip() or None) if domain else None,
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid filter: {e}") from e
     start = datetime.now()
-    if query:
-        query_results = cached_query(query)
-        results = (
+    timer = StageTimer(stage_seconds)
+    # A whitespace-only query shows the front page rather than searching nothing
+    if query and normalize_query(query):
+        # The front page only needs the feed, so only searches wait for the model
+        if not ready.is_set():
+            raise HTTPException(
+                status_code=503,
+                detail="Starting up, please try again",
+                headers={"Retry-After": "1"},
+            )
+        if mode != "vector" and not text_index_available:
+            raise HTTPException(
+                status_code=400,
+                detail=f"{mode} search needs the full-text index, see text_index.py",
+            )
+        query_results, search_seconds = await search(query, mode, filters)
+        # Identical concurrent searches share the stages of one computation, so
+        # they're only observed by the request that ran it
+        timer.seconds.update(search_seconds)
+        results = [
             {"doc": doc, "distances": [s["distance"] for s in search_info]}
             for doc, search_info in query_results
-        )
+        ]
         feed = None
     else:
-        feed = cached_feed()
+        feed = feed_refresher.entries
         results = None
-    return templates.TemplateResponse(
-        request=request,
-        name="search.html",
-        context={
-            "query": query,
-            "results": results,
-            "feed": feed,
-            "doc_count": cached_doc_count(),
-            "load_time": datetime.now() - start,
-        },
-    )
+    doc_count = await asyncio.to_thread(cached_doc_count)
+    # Templates render when the response is created
+    with timer.stage("render"):
+        response = templates.TemplateResponse(
+            request=request,
+            name="search.html",
+            context={
+                "query": query,
+                "mode": mode,
+                "filters": filters,
+                "results": results,
+                "feed": feed,
+                "doc_count": doc_count,
+                "load_time": datetime.now() - start,
+            },
+        )
+    response.headers["Server-Timing"] = timer.server_timing()
+    return response